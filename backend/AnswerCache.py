@@ -0,0 +1,61 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Set
+
+
+def answer_key(normalized_query: str, file_id_list: List[str], context: str, version: str = '') -> str:
+    # version: 文档当前的版本, 其他进程重新入库或删除文档后, 旧答案不会再命中
+    context_hash = hashlib.sha256(context.encode()).hexdigest()
+    return hashlib.sha256('\x00'.join([normalized_query, ','.join(sorted(file_id_list)), context_hash, version]).encode()).hexdigest()
+
+
+class AnswerCache:
+    """LRU + TTL cache of full answers, keyed by normalized query, file ids and retrieved context."""
+
+    def __init__(self, max_items: int = 1000, ttl: int = 86400):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple] = OrderedDict()
+        self._keys_by_file: Dict[str, Set[str]] = defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, key: str):
+        _, _, file_id_list = self._items.pop(key)
+        for file_id in file_id_list:
+            keys = self._keys_by_file.get(file_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_file[file_id]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.time() - item[1] > self.ttl:
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: str, answer: str, file_id_list: List[str]):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (answer, time.time(), list(file_id_list))
+            for file_id in file_id_list:
+                self._keys_by_file[file_id].add(key)
+            while len(self._items) > self.max_items:
+                self._remove(next(iter(self._items)))
+
+    def invalidate(self, file_id: str):
+        # 文件重新入库后, 和它相关的答案全部作废
+        with self._lock:
+            for key in list(self._keys_by_file.get(file_id, ())):
+                self._remove(key)
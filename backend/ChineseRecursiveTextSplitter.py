@@ -1,37 +1,29 @@
 import re
-from typing import List, Optional, Any
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import logging
+from typing import Callable, List, Optional, Tuple
 
+_blank_lines_pattern = re.compile(r"\n{2,}")
+
+
+class ChineseRecursiveTextSplitter:
+    """Recursive splitter for Chinese / English text that works on offsets of the source text.
+
+    Chunks are the same as the previous LangChain based implementation (separators
+    kept at the end of each piece, pieces merged up to chunk_size with chunk_overlap),
+    but separators are precompiled, every level searches the source text in place with
+    pos/endpos instead of copying substrings, and merging walks a window of spans.
+    `split_text_with_offsets` also returns where each chunk starts and ends in the text.
+    """
 
-def _split_text_with_regex_from_end(
-        text: str, separator: str, keep_separator: bool
-) -> List[str]:
-    # Now that we have the separator, split the text
-    if separator:
-        if keep_separator:
-            # The parentheses in the pattern keep the delimiters in the result.
-            _splits = re.split(f"({separator})", text)
-            splits = ["".join(i) for i in zip(_splits[0::2], _splits[1::2])]
-            if len(_splits) % 2 == 1:
-                splits += _splits[-1:]
-            # splits = [_splits[0]] + splits
-        else:
-            splits = re.split(separator, text)
-    else:
-        splits = list(text)
-    return [s for s in splits if s != ""]
-    
-class ChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
     def __init__(
             self,
             separators: Optional[List[str]] = None,
-            keep_separator: bool = True,
             is_separator_regex: bool = True,
-            **kwargs: Any,
+            chunk_size: int = 4000,
+            chunk_overlap: int = 200,
+            length_function: Callable[[str], int] = len,
     ) -> None:
-        """Create a new TextSplitter."""
-        super().__init__(keep_separator=keep_separator, **kwargs)
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"Got a larger chunk overlap ({chunk_overlap}) than chunk size ({chunk_size}), should be smaller.")
         self._separators = separators or [
             "\n\n",
             # "\n", # 很多pdf解析出来的文字换行是原始换行在句子中间，并不表示是分段
@@ -40,45 +32,90 @@ class ChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
             "；|;\s",
             "，|,\s"
         ]
-        self._is_separator_regex = is_separator_regex
+        # 空字符串表示按单个字符切分, 不需要正则
+        self._patterns = [re.compile(s if is_separator_regex else re.escape(s)) if s else None
+                          for s in self._separators]
+        self._chunk_size = chunk_size
+        self._chunk_overlap = chunk_overlap
+        self._length_function = length_function
+        self._separator_len = length_function("")
+        # 默认按字符数计算长度, 直接用下标差, 不切出子串
+        self._length_is_len = length_function is len
+
+    def split_text(self, text: str) -> List[str]:
+        return [chunk for chunk, _, _ in self.split_text_with_offsets(text)]
 
-    def _split_text(self, text: str, separators: List[str]) -> List[str]:
-        """Split incoming text and return chunks."""
-        final_chunks = []
-        # Get appropriate separator to use
-        separator = separators[-1]
-        new_separators = []
-        for i, _s in enumerate(separators):
-            _separator = _s if self._is_separator_regex else re.escape(_s)
-            if _s == "":
-                separator = _s
+    def split_text_with_offsets(self, text: str) -> List[Tuple[str, int, int]]:
+        """Return [(chunk, start, end)]; the chunk is text[start:end] with runs of blank lines collapsed."""
+        spans = []
+        self._split_span(text, 0, len(text), 0, spans)
+        result = []
+        for start, end in spans:
+            piece = text[start:end]
+            stripped = piece.strip()
+            if stripped == "":
+                continue
+            start += len(piece) - len(piece.lstrip())
+            chunk = _blank_lines_pattern.sub("\n", stripped) if "\n\n" in stripped else stripped
+            result.append((chunk, start, start + len(stripped)))
+        return result
+
+    def _pieces(self, text: str, start: int, end: int, level: int) -> List[Tuple[int, int]]:
+        # 每段以分隔符结尾 (保留分隔符), 最后一段是剩余部分
+        pattern = self._patterns[level]
+        if pattern is None:
+            return [(i, i + 1) for i in range(start, end)]
+        ends = [m.end() for m in pattern.finditer(text, start, end)]
+        if not ends or ends[-1] != end:
+            ends.append(end)
+        return [(s, e) for s, e in zip([start] + ends[:-1], ends) if e > s]
+
+    def _split_span(self, text: str, start: int, end: int, first_level: int, spans: List[Tuple[int, int]]):
+        # 选择第一个在这段文字中出现的分隔符, 都不出现时用最后一个
+        level = len(self._patterns) - 1
+        has_next = False
+        for i in range(first_level, len(self._patterns)):
+            pattern = self._patterns[i]
+            if pattern is None:
+                level = i
                 break
-            if re.search(_separator, text):
-                separator = _s
-                new_separators = separators[i + 1:]
+            if pattern.search(text, start, end):
+                level = i
+                has_next = i + 1 < len(self._patterns)
                 break
 
-        _separator = separator if self._is_separator_regex else re.escape(separator)
-        splits = _split_text_with_regex_from_end(text, _separator, self._keep_separator)
-
-        # Now go merging things, recursively splitting longer texts.
-        _good_splits = []
-        _separator = "" if self._keep_separator else separator
-        for s in splits:
-            if self._length_function(s) < self._chunk_size:
-                _good_splits.append(s)
+        good = []
+        for piece_start, piece_end in self._pieces(text, start, end, level):
+            length = piece_end - piece_start if self._length_is_len else self._length_function(text[piece_start:piece_end])
+            if length < self._chunk_size:
+                good.append((piece_start, piece_end, length))
+                continue
+            if good:
+                self._merge_spans(good, spans)
+                good = []
+            if not has_next:
+                spans.append((piece_start, piece_end))
             else:
-                if _good_splits:
-                    merged_text = self._merge_splits(_good_splits, _separator)
-                    final_chunks.extend(merged_text)
-                    _good_splits = []
-                if not new_separators:
-                    final_chunks.append(s)
-                else:
-                    other_info = self._split_text(s, new_separators)
-                    final_chunks.extend(other_info)
-        if _good_splits:
-            merged_text = self._merge_splits(_good_splits, _separator)
-            final_chunks.extend(merged_text)
-        lst = [re.sub(r"\n{2,}", "\n", chunk.strip()) for chunk in final_chunks if chunk.strip()!=""]
-        return lst
+                self._split_span(text, piece_start, piece_end, level + 1, spans)
+        if good:
+            self._merge_spans(good, spans)
+
+    def _merge_spans(self, pieces: List[Tuple[int, int, int]], spans: List[Tuple[int, int]]):
+        # 和 LangChain TextSplitter._merge_splits 相同的合并规则, 窗口用下标表示, 不复制列表
+        sep_len = self._separator_len
+        head = 0
+        cnt = 0
+        total = 0
+        for i, (_, _, length) in enumerate(pieces):
+            if total + length + (sep_len if cnt > 0 else 0) > self._chunk_size:
+                if cnt > 0:
+                    spans.append((pieces[head][0], pieces[i - 1][1]))
+                    while cnt > 0 and (total > self._chunk_overlap or (
+                            total + length + (sep_len if cnt > 0 else 0) > self._chunk_size and total > 0)):
+                        total -= pieces[head][2] + (sep_len if cnt > 1 else 0)
+                        head += 1
+                        cnt -= 1
+            cnt += 1
+            total += length + (sep_len if cnt > 1 else 0)
+        if cnt > 0:
+            spans.append((pieces[head][0], pieces[-1][1]))
@@ -1,18 +1,28 @@
-import os
+import hashlib
+import metrics
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional, List, Any
 import logging
 
 import chromadb
 from chromadb.config import Settings
-from chromadb.utils import embedding_functions
 from chromadb import Collection, QueryResult
 from chromadb.errors import InvalidDimensionException
+try:
+    from chromadb.errors import InvalidCollectionException
+except ImportError:
+    # 老版本的 chromadb 找不到 collection 时抛 ValueError
+    InvalidCollectionException = ValueError
 
 from langchain.docstore.document import Document
 
+from EmbeddingCache import EmbeddingCache
+from embedding_backends import create_embedding_backend, collection_suffix
+
 
 class ChromaDB:
-    def __init__(self, my_dir, collection_name):
+    def __init__(self, my_dir, collection_name, embedding_backend=None, shard_by_document=False, max_query_workers=8):
         chromadb_settings = Settings()
 
         use_server = False
@@ -26,12 +36,20 @@ class ChromaDB:
 
         self.client = chromadb.Client(chromadb_settings)
 
-        self.embedding_fn = embedding_functions.OpenAIEmbeddingFunction(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            organization_id=os.getenv("OPENAI_ORGANIZATION"),
-            model_name="text-embedding-ada-002",
-        )
-        self.switch_to_collection(collection_name)
+        self.embedding_backend = embedding_backend or create_embedding_backend('openai')
+        # add 和 query 都经过缓存, 只有未命中的文本才会请求 embedding backend
+        self.embedding_fn = EmbeddingCache(self.embedding_backend, self.embedding_backend.model_name,
+                                           my_dir + "_embedding_cache.sqlite3")
+        # 每个 backend 单独一个 collection, 向量维度不会混用
+        self.switch_to_collection(collection_name + collection_suffix(self.embedding_backend))
+
+        # 按文档分片: 每个文档一个 collection, 多文档查询并行扇出后按距离合并
+        # 分片之前入库的老文档仍然在共享的 collection 里, 查询时按 file_id 过滤, 重新入库时整篇搬进分片
+        # 分片可能由其他进程创建或删除, 这里只缓存打开过的分片, 不缓存"不存在"
+        self.shard_by_document = shard_by_document
+        self._shards: Dict[str, Collection] = {}
+        self._shard_lock = threading.Lock()
+        self._query_executor = ThreadPoolExecutor(max_workers=max_query_workers, thread_name_prefix='chroma-query')
 
 
     def switch_to_collection(self, collection_name: str):
@@ -41,6 +59,57 @@ class ChromaDB:
         )
     
 
+    def _shard_name(self, file_id: str) -> str:
+        name = f'{self.collection.name}_{file_id}'
+        if len(name) > 63:
+            # chroma 的 collection 名最长 63 个字符
+            name = f'{self.collection.name[:40]}_{hashlib.md5(file_id.encode()).hexdigest()[:16]}'
+        return name
+
+    def _collection_for(self, file_id: Optional[str] = None, create: bool = True) -> Optional[Collection]:
+        if not self.shard_by_document or file_id is None:
+            return self.collection
+        with self._shard_lock:
+            shard = self._shards.get(file_id)
+            if shard is None:
+                name = self._shard_name(file_id)
+                if create:
+                    shard = self.client.get_or_create_collection(name=name, embedding_function=self.embedding_fn)
+                    # 老文档第一次写入分片前, 先把它在共享 collection 里的 chunk 搬过来
+                    self._move_legacy_chunks(file_id, shard)
+                else:
+                    try:
+                        shard = self.client.get_collection(name=name, embedding_function=self.embedding_fn)
+                    except (InvalidCollectionException, ValueError):
+                        return None
+                self._shards[file_id] = shard
+            return shard
+
+    def _forget_shard(self, file_id: str):
+        # 分片已被其他进程删除
+        with self._shard_lock:
+            self._shards.pop(file_id, None)
+
+    def _move_legacy_chunks(self, file_id: str, shard: Collection, batch_size: int = 500):
+        # 先写入分片再从共享 collection 删除, 中断后下次打开分片时接着搬, 重复写入不影响结果
+        moved = 0
+        while True:
+            batch = self.collection.get(where={"file_id": file_id}, limit=batch_size,
+                                        include=["documents", "metadatas", "embeddings"])
+            if not batch["ids"]:
+                break
+            shard.upsert(ids=batch["ids"], embeddings=batch["embeddings"],
+                         documents=batch["documents"], metadatas=batch["metadatas"])
+            self.collection.delete(ids=batch["ids"])
+            moved += len(batch["ids"])
+        if moved:
+            logging.info(f"moved legacy chunks into shard, file_id={file_id}, chunks={moved}")
+
+    def _file_where(self, file_id_list: List[str]) -> Dict[str, any]:
+        if (len(file_id_list) == 1):
+            return {"file_id": file_id_list[0]}
+        return {"$or": [{"file_id": file_id} for file_id in file_id_list]}
+
     def _generate_where_clause(self, where: Dict[str, any]) -> str:
         if len(where.keys()) == 1:
             return where
@@ -50,7 +119,8 @@ class ChromaDB:
                 where_filters.append({k: v})
         return {"$and": where_filters}
 
-    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, any]] = None, limit: Optional[int] = None):
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, any]] = None, limit: Optional[int] = None,
+            file_id: Optional[str] = None):
         args = {}
         if ids:
             args["ids"] = ids
@@ -58,18 +128,21 @@ class ChromaDB:
             args["where"] = self._generate_where_clause(where)
         if limit:
             args["limit"] = limit
-        return self.collection.get(**args)
+        return self._collection_for(file_id).get(**args)
 
     def add(
         self,
         documents: List[str],
         metadatas: List[object],
-        ids: List[str]
+        ids: List[str],
+        embeddings: Optional[List[List[float]]] = None,
+        file_id: Optional[str] = None
     ) -> Any:
         BATCH_SIZE = 100
+        collection = self._collection_for(file_id)
         size = len(documents)
 
-        if len(documents) != size or len(metadatas) != size or len(ids) != size:
+        if len(documents) != size or len(metadatas) != size or len(ids) != size or (embeddings is not None and len(embeddings) != size):
             raise ValueError(
                 "Cannot add documents to chromadb with inconsistent sizes. Documents size: {}, Metadata size: {},"
                 " Ids size: {}".format(len(documents), len(metadatas), len(ids))
@@ -77,11 +150,26 @@ class ChromaDB:
 
         for i in range(0, len(documents), BATCH_SIZE):
             logging.info("Inserting batches from {} to {} in chromadb".format(i, min(len(documents), i + BATCH_SIZE)))
-            self.collection.add(
-                documents=documents[i : i + BATCH_SIZE],
-                metadatas=metadatas[i : i + BATCH_SIZE],
-                ids=ids[i : i + BATCH_SIZE],
-            )
+            args = {}
+            if embeddings is not None:
+                args["embeddings"] = embeddings[i : i + BATCH_SIZE]
+            with metrics.span('chroma_add'):
+                collection.add(
+                    documents=documents[i : i + BATCH_SIZE],
+                    metadatas=metadatas[i : i + BATCH_SIZE],
+                    ids=ids[i : i + BATCH_SIZE],
+                    **args,
+                )
+
+    def embed(self, documents: List[str], batch_size: int = 500, max_workers: int = 4) -> List[List[float]]:
+        # 大批量请求 embedding, 同时在途的请求数不超过 max_workers
+        batches = [documents[i : i + batch_size] for i in range(0, len(documents), batch_size)]
+        if len(batches) <= 1:
+            return [vector for batch in batches for vector in self.embedding_fn(batch)]
+        logging.info(f"Embedding {len(documents)} documents in {len(batches)} batches, max_workers={max_workers}")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self.embedding_fn, batches))
+        return [vector for batch in results for vector in batch]
 
     def _format_result(self, results: QueryResult) -> list[tuple[Document, float]]:
         return [
@@ -93,15 +181,21 @@ class ChromaDB:
             )
         ]
 
-    def query(self, input_query: str, n_results: int, where: Dict[str, any]) -> list[tuple[Document, float]]:
+    def query(self, input_query: str, n_results: int, where: Optional[Dict[str, any]],
+              query_embedding: Optional[List[float]] = None, file_id: Optional[str] = None) -> list[tuple[Document, float]]:
+        # 已经算好 query 的 embedding 时直接用, 不再重复请求
+        if query_embedding is not None:
+            args = {"query_embeddings": [query_embedding]}
+        else:
+            args = {"query_texts": [input_query]}
+        if where:
+            args["where"] = self._generate_where_clause(where)
         try:
-            result = self.collection.query(
-                query_texts=[
-                    input_query,
-                ],
-                n_results=n_results,
-                where=self._generate_where_clause(where),
-            )
+            with metrics.span('chroma_query'):
+                result = self._collection_for(file_id).query(
+                    n_results=n_results,
+                    **args,
+                )
         except InvalidDimensionException as e:
             raise InvalidDimensionException(
                 e.message()
@@ -110,6 +204,31 @@ class ChromaDB:
             ) from None
         return self._format_result(result)
 
+    def _query_doc(self, input_query: str, n_results: int, query_embedding: Optional[List[float]], file_id: str):
+        try:
+            return self.query(input_query, n_results, None, query_embedding, file_id)
+        except InvalidCollectionException:
+            # 分片被其他进程删除了, 重新确认一次; 没有分片就按 file_id 查共享 collection
+            self._forget_shard(file_id)
+            if self._collection_for(file_id, create=False) is not None:
+                return self.query(input_query, n_results, None, query_embedding, file_id)
+            return self.query(input_query, n_results, self._file_where([file_id]), query_embedding)
+
+    def query_docs(self, file_id_list: List[str], input_query: str, n_results: int,
+                   query_embedding: Optional[List[float]] = None) -> list[tuple[Document, float]]:
+        """Top n_results chunks of every document (per shard when sharded), merged by distance."""
+        if not self.shard_by_document:
+            return self.query(input_query, n_results, self._file_where(file_id_list), query_embedding)
+
+        sharded = [file_id for file_id in file_id_list if self._collection_for(file_id, create=False) is not None]
+        legacy = [file_id for file_id in file_id_list if file_id not in sharded]
+        futures = [self._query_executor.submit(self._query_doc, input_query, n_results, query_embedding, file_id)
+                   for file_id in sharded]
+        if legacy:
+            futures.append(self._query_executor.submit(
+                self.query, input_query, n_results, self._file_where(legacy), query_embedding))
+        results = [doc_and_dist for future in futures for doc_and_dist in future.result()]
+        return sorted(results, key=lambda doc_and_dist: doc_and_dist[1])
 
     def count(self) -> int:
         return self.collection.count()
@@ -117,6 +236,31 @@ class ChromaDB:
     def delete(self, where):
         return self.collection.delete(where=where)
 
+    def delete_pages(self, file_id: str, page_keys: List[str]):
+        # 删除文档中指定页面的所有 chunk, 分片和共享 collection 里都要删
+        collections = [self.collection]
+        shard = self._collection_for(file_id, create=False)
+        if shard is not None and shard is not self.collection:
+            collections.append(shard)
+        for page_key in page_keys:
+            where = self._generate_where_clause({"file_id": file_id, "page_index": page_key})
+            for collection in collections:
+                try:
+                    collection.delete(where=where)
+                except InvalidCollectionException:
+                    self._forget_shard(file_id)
+
+    def delete_doc(self, file_id: str):
+        # 分片的文档直接删掉整个 collection, 老文档从共享 collection 里按 file_id 删除
+        if self.shard_by_document:
+            with self._shard_lock:
+                self._shards.pop(file_id, None)
+                try:
+                    self.client.delete_collection(name=self._shard_name(file_id))
+                except (InvalidCollectionException, ValueError):
+                    pass
+        self.collection.delete(where={"file_id": file_id})
+
     def reset(self):
         collection_name = self.collection.name
         try:
@@ -127,5 +271,7 @@ class ChromaDB:
                 "Please enable it by setting `allow_reset=True` in your ChromaDbConfig"
             ) from None
         self.switch_to_collection(collection_name)
+        with self._shard_lock:
+            self._shards = {}
 
 
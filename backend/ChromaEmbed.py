@@ -1,24 +1,30 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple
 import hashlib
 import logging
 
+import metrics
+
 from ChromaDB import ChromaDB
 from ChineseRecursiveTextSplitter import ChineseRecursiveTextSplitter
 
+chunks_embedded = metrics.counter('chatbot_chunks_embedded_total', 'Chunks embedded and written to the vector db')
+
 def _create_chunks(text_splitter: ChineseRecursiveTextSplitter, text_content: str, metadata: Dict[str, Any]):
     documents = []
     chunk_ids = []
     metadatas = []
 
-    chunks = text_splitter.split_text(text_content)
+    seen_ids = set()
 
-    for chunk in chunks:
+    for chunk, start, end in text_splitter.split_text_with_offsets(text_content):
+        # id 只由内容和页面 metadata 决定, 偏移量只记录在 chunk 的 metadata 里
         chunk_id = hashlib.sha256((chunk + str(metadata)).encode()).hexdigest()
-        if (chunk_id in chunk_ids):
+        if (chunk_id in seen_ids):
             continue
+        seen_ids.add(chunk_id)
         chunk_ids.append(chunk_id)
         documents.append(chunk)
-        metadatas.append(metadata)
+        metadatas.append({**metadata, 'chunk_start': start, 'chunk_end': end})
 
     return {
         "documents": documents,
@@ -27,45 +33,60 @@ def _create_chunks(text_splitter: ChineseRecursiveTextSplitter, text_content: st
     }
 
 
-def load_and_embed(
+def load_and_embed_pages(
     db: ChromaDB,
     text_splitter: ChineseRecursiveTextSplitter,
-    text_content: str,
+    pages: List[Tuple[str, Dict[str, Any]]],
     file_id: str,
-    metadata: Dict[str, Any]
+    batch_size: int = 500,
+    max_workers: int = 4,
+    on_chunks=None
 ):
-    embeddings_data = _create_chunks(text_splitter, text_content, metadata)
-
-    documents = embeddings_data["documents"]
-    metadatas = embeddings_data["metadatas"]
-    ids = embeddings_data["ids"]
+    """Split every page of a document first, then dedup and embed all chunks in large batches.
 
-    where = {"file_id": file_id}
-
-    db_result = db.get(ids=ids, where=where)
+    on_chunks(documents, metadatas, ids) receives every chunk of the pages, before the dedup against the db.
+    """
+    documents = []
+    metadatas = []
+    ids = []
+    seen_ids = set()
+    for text_content, metadata in pages:
+        embeddings_data = _create_chunks(text_splitter, text_content, metadata)
+        for doc, meta, id in zip(embeddings_data["documents"], embeddings_data["metadatas"], embeddings_data["ids"]):
+            if id in seen_ids:
+                continue
+            seen_ids.add(id)
+            documents.append(doc)
+            metadatas.append(meta)
+            ids.append(id)
+
+    if on_chunks:
+        on_chunks(documents, metadatas, ids)
+
+    if not ids:
+        return [], [], [], 0
+
+    db_result = db.get(ids=ids, where={"file_id": file_id}, file_id=file_id)
     existing_ids = set(db_result["ids"])
 
     if len(existing_ids):
-        all_data_dict = {id: (doc, meta) for id, doc, meta in zip(ids, documents, metadatas)}
-        new_data_dict = {id: value for id, value in all_data_dict.items() if id not in existing_ids}
-
-        if not new_data_dict:
+        new_data = [(id, doc, meta) for id, doc, meta in zip(ids, documents, metadatas) if id not in existing_ids]
+        if not new_data:
             logging.info(f"All chunks already exists in the database.")
             return [], [], [], 0
-        else:
-            logging.info(f"all chunks={len(all_data_dict)}, old={len(existing_ids)}, new={len(new_data_dict)}")
-
-        documents, metadatas = zip(*new_data_dict.values())
-        ids = list(new_data_dict.keys())
-
-    chunks_before_addition = db.count()
+        logging.info(f"all chunks={len(ids)}, old={len(existing_ids)}, new={len(new_data)}")
+        ids, documents, metadatas = (list(x) for x in zip(*new_data))
 
+    with metrics.span('embed_chunks'):
+        embeddings = db.embed(documents, batch_size=batch_size, max_workers=max_workers)
     db.add(
-        documents=list(documents),
-        metadatas=list(metadatas),
-        ids=ids
+        documents=documents,
+        metadatas=metadatas,
+        ids=ids,
+        embeddings=embeddings,
+        file_id=file_id
     )
-    count_new_chunks = db.count() - chunks_before_addition
 
-    logging.info(f"Successfully saved to db. New chunks count: {count_new_chunks}")
-    return list(documents), metadatas, ids, count_new_chunks
+    chunks_embedded.inc(len(ids))
+    logging.info(f"Successfully saved to db. New chunks count: {len(ids)}")
+    return documents, metadatas, ids, len(ids)
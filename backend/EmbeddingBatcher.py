@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import metrics
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+batch_size = metrics.histogram('chatbot_query_embed_batch_size', 'Texts carried by each coalesced query embedding call',
+                               buckets=BATCH_SIZE_BUCKETS)
+
+
+class EmbeddingBatcher:
+    """Coalesces query embeddings from concurrent requests into one embedding call.
+
+    Texts arriving within `window_ms` (or until `max_batch` texts are waiting) are
+    embedded together in a worker thread. The number of texts each call carried
+    goes to the chatbot_query_embed_batch_size histogram.
+    """
+
+    def __init__(self, embedding_fn, window_ms: float = 5, max_batch: int = 64):
+        self.embedding_fn = embedding_fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        batch_size.observe(len(batch))
+        try:
+            vectors = await asyncio.to_thread(self.embedding_fn, texts)
+        except Exception as e:
+            logging.exception(f'embedding batch failed, size={len(batch)}')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        vector_by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vector_by_text[text])
@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+
+def embedding_key(text: str, model_name: str) -> str:
+    # 只用 文本 + 模型 做 key, 同一段文字在不同文件/重复上传之间共享
+    return hashlib.sha256((model_name + '\x00' + text).encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache in front of a chroma embedding function.
+
+    Embeddings are persisted in a sqlite file and the hottest entries are kept
+    in an in-memory LRU, so the wrapped function is only called on misses.
+    """
+
+    def __init__(self, embedding_fn, model_name: str, db_path: str, max_memory_items: int = 20000):
+        self.embedding_fn = embedding_fn
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+        self._lru: OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embedding (key TEXT PRIMARY KEY, model TEXT, vector BLOB)')
+        self._conn.commit()
+
+    def _lru_get(self, key: str) -> Optional[List[float]]:
+        vector = self._lru.get(key)
+        if vector is not None:
+            self._lru.move_to_end(key)
+        return vector
+
+    def _lru_put(self, key: str, vector: List[float]):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_memory_items:
+            self._lru.popitem(last=False)
+
+    def _disk_get(self, keys: List[str]) -> dict:
+        found = {}
+        BATCH_SIZE = 500
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i : i + BATCH_SIZE]
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embedding WHERE key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = array('f', blob).tolist()
+        return found
+
+    def _disk_put(self, items: dict):
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO embedding (key, model, vector) VALUES (?, ?, ?)',
+            [(key, self.model_name, array('f', vector).tobytes()) for key, vector in items.items()],
+        )
+        self._conn.commit()
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        keys = [embedding_key(text, self.model_name) for text in input]
+        result: List[Optional[List[float]]] = [None] * len(input)
+
+        with self._lock:
+            missing_keys = []
+            for i, key in enumerate(keys):
+                vector = self._lru_get(key)
+                if vector is not None:
+                    result[i] = vector
+                else:
+                    missing_keys.append(key)
+            if missing_keys:
+                for key, vector in self._disk_get(list(set(missing_keys))).items():
+                    self._lru_put(key, vector)
+                for i, key in enumerate(keys):
+                    if result[i] is None:
+                        result[i] = self._lru_get(key)
+
+        # 同一批里重复的文本只请求一次
+        miss_texts = {}
+        for i, key in enumerate(keys):
+            if result[i] is None and key not in miss_texts:
+                miss_texts[key] = input[i]
+
+        self.hits += len(input) - len(miss_texts)
+        self.misses += len(miss_texts)
+        if miss_texts:
+            logging.info(f'embedding cache, total={len(input)}, miss={len(miss_texts)}')
+            vectors = self.embedding_fn(list(miss_texts.values()))
+            new_items = {key: list(vector) for key, vector in zip(miss_texts.keys(), vectors)}
+            with self._lock:
+                self._disk_put(new_items)
+                for key, vector in new_items.items():
+                    self._lru_put(key, vector)
+            for i, key in enumerate(keys):
+                if result[i] is None:
+                    result[i] = new_items[key]
+
+        return result
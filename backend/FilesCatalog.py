@@ -0,0 +1,111 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional
+
+FIELDS = ['file_id', 'filename', 'newfilename', 'file_md5', 'selected', 'uploadtime', 'url', 'status']
+
+# ingesting: 新文档解析时已经提前加入列表, 入库还没完成
+STATUS_READY = 'ready'
+STATUS_INGESTING = 'ingesting'
+
+
+class FilesCatalog:
+    """Uploaded-file catalog in sqlite, replacing the periodically dumped files_db json.
+
+    Every write is committed immediately; file_id and file_md5 are unique indexes,
+    a record whose md5 already belongs to another file is not stored.
+    """
+
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    file_id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    newfilename TEXT,
+                    file_md5 TEXT,
+                    selected INTEGER DEFAULT 0,
+                    uploadtime TEXT,
+                    url TEXT,
+                    status TEXT DEFAULT 'ready'
+                )""")
+            if 'status' not in {row[1] for row in self._conn.execute('PRAGMA table_info(files)')}:
+                self._conn.execute(f"ALTER TABLE files ADD COLUMN status TEXT DEFAULT '{STATUS_READY}'")
+            self._conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_files_md5 ON files (file_md5)')
+            self._conn.commit()
+
+    def _to_dict(self, row: sqlite3.Row) -> Dict:
+        record = dict(row)
+        record['selected'] = bool(record['selected'])
+        return record
+
+    def import_json(self, json_path: str):
+        # 从老的 <APP_NAME>_files_db.json 导入, 只在 catalog 为空时执行一次
+        if not os.path.exists(json_path) or self.count() > 0:
+            return
+        with open(json_path, 'r') as f:
+            files_db = json.load(f)
+        imported = sum(self.put(record) for record in files_db.values())
+        logging.info(f'imported {imported}/{len(files_db)} files from {json_path}')
+
+    def put(self, record: Dict) -> bool:
+        """Insert or update by file_id; returns False, keeping the other file, if the md5 belongs to another file_id."""
+        values = [record.get(k) for k in FIELDS]
+        values[FIELDS.index('file_id')] = str(record['file_id'])
+        values[FIELDS.index('selected')] = int(bool(record.get('selected')))
+        values[FIELDS.index('status')] = record.get('status') or STATUS_READY
+        updates = ','.join(f'{k} = excluded.{k}' for k in FIELDS if k != 'file_id')
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    f"INSERT INTO files ({','.join(FIELDS)}) VALUES ({','.join('?' * len(FIELDS))})"
+                    f" ON CONFLICT(file_id) DO UPDATE SET {updates}", values)
+        except sqlite3.IntegrityError:
+            # md5 唯一索引冲突: 不能用 REPLACE, 否则会把另一个文件的记录删掉
+            existing = self.get_by_md5(record.get('file_md5'))
+            logging.warning(f'file_md5 already in catalog, skipped, file_id={record["file_id"]}, '
+                            f'existing file_id={existing["file_id"] if existing else None}')
+            return False
+        return True
+
+    def get(self, file_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM files WHERE file_id = ?', (str(file_id),)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def get_by_md5(self, file_md5: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM files WHERE file_md5 = ?', (file_md5,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, offset: int = 0, limit: Optional[int] = None, keyword: Optional[str] = None) -> List[Dict]:
+        sql = 'SELECT * FROM files'
+        args = []
+        if keyword:
+            sql += ' WHERE filename LIKE ?'
+            args.append(f'%{keyword}%')
+        sql += ' ORDER BY rowid LIMIT ? OFFSET ?'
+        args += [limit if limit is not None else -1, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def count(self, keyword: Optional[str] = None) -> int:
+        sql = 'SELECT COUNT(*) FROM files'
+        args = []
+        if keyword:
+            sql += ' WHERE filename LIKE ?'
+            args.append(f'%{keyword}%')
+        with self._lock:
+            return self._conn.execute(sql, args).fetchone()[0]
+
+    def delete(self, file_id: str):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM files WHERE file_id = ?', (str(file_id),))
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+
+stage_failures = metrics.counter('chatbot_ingest_stage_failures_total', 'Failed ingest stage attempts')
+
+
+class IngestQueue:
+    """Persistent ingestion job queue backed by sqlite.
+
+    A job walks through the configured stages in order; each stage has its own
+    worker threads. Lower priority values run first, failed stages are retried
+    with exponential backoff. Several processes can share the database: a claim
+    is a conditional update that only one of them wins, and holds a lease that
+    a heartbeat keeps renewing, so jobs of a process that died are queued again
+    once their lease expires. Stages can record finished page keys with
+    `mark_pages_done` so a resumed job skips them.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        stages: List[Tuple[str, Callable[[str, dict], Optional[dict]], int]],
+        max_attempts: int = 3,
+        backoff_seconds: float = 10,
+        on_failed: Optional[Callable[[str, str, dict, str], None]] = None,
+        lease_seconds: float = 60,
+    ):
+        self.stages = stages
+        self.stage_names = [name for name, _, _ in stages]
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.on_failed = on_failed
+        self.lease_seconds = lease_seconds
+        # 每次领取任务生成一个 owner, 完成/失败时只更新自己领取的那一次
+        self._owner_prefix = f'{socket.gethostname()}:{os.getpid()}:'
+        self._claims: Set[str] = set()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    stage TEXT,
+                    state TEXT,
+                    priority INTEGER,
+                    args TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    next_run_at REAL,
+                    last_error TEXT,
+                    created_at REAL,
+                    updated_at REAL,
+                    owner TEXT,
+                    lease_until REAL
+                )""")
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')}
+            for column, column_type in (('owner', 'TEXT'), ('lease_until', 'REAL')):
+                if column not in columns:
+                    self._conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (stage, state, priority, created_at)')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_pages (
+                    job_id TEXT,
+                    page_key TEXT,
+                    PRIMARY KEY (job_id, page_key)
+                )""")
+
+    def enqueue(self, job_id: str, args: dict, priority: int = 0, stage: Optional[str] = None) -> bool:
+        """Queue a job, replacing a finished, failed or still queued one; returns False while it is running."""
+        now = time.time()
+        with self._cond:
+            with self._conn:
+                accepted = self._conn.execute(
+                    'INSERT INTO jobs (job_id, stage, state, priority, args, attempts, next_run_at, created_at, updated_at)'
+                    " VALUES (?, ?, 'queued', ?, ?, 0, ?, ?, ?)"
+                    ' ON CONFLICT(job_id) DO UPDATE SET stage = excluded.stage, state = excluded.state,'
+                    ' priority = excluded.priority, args = excluded.args, attempts = 0, next_run_at = excluded.next_run_at,'
+                    ' last_error = NULL, created_at = excluded.created_at, updated_at = excluded.updated_at,'
+                    " owner = NULL, lease_until = NULL WHERE jobs.state != 'running'",
+                    (job_id, stage or self.stage_names[0], priority, json.dumps(args, ensure_ascii=False), now, now, now)).rowcount
+                if accepted:
+                    self._conn.execute('DELETE FROM job_pages WHERE job_id = ?', (job_id,))
+            self._cond.notify_all()
+        if not accepted:
+            logging.warning(f'ingest job is running, enqueue rejected, job_id={job_id}')
+            return False
+        logging.info(f'enqueue ingest job, job_id={job_id}, stage={stage or self.stage_names[0]}, priority={priority}')
+        return True
+
+    def mark_pages_done(self, job_id: str, page_keys: List[str]):
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO job_pages (job_id, page_key) VALUES (?, ?)',
+                                   [(job_id, key) for key in page_keys])
+
+    def completed_pages(self, job_id: str) -> Set[str]:
+        with self._lock:
+            rows = self._conn.execute('SELECT page_key FROM job_pages WHERE job_id = ?', (job_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def depth(self) -> Dict[str, Dict[str, int]]:
+        # 每个阶段各状态的任务数
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, state, COUNT(*) FROM jobs WHERE state IN ('queued', 'running') GROUP BY stage, state").fetchall()
+        result = {name: {'queued': 0, 'running': 0} for name in self.stage_names}
+        for stage, state, cnt in rows:
+            result.setdefault(stage, {})[state] = cnt
+        return result
+
+    def _claim(self, stage: str) -> Optional[Tuple[str, dict, str]]:
+        # 条件更新领取, 多个进程同时看到同一个任务时只有一个能更新成功
+        while True:
+            now = time.time()
+            row = self._conn.execute(
+                "SELECT job_id, args, updated_at FROM jobs WHERE stage = ? AND state = 'queued' AND next_run_at <= ?"
+                " ORDER BY priority, created_at LIMIT 1", (stage, now)).fetchone()
+            if row is None:
+                return None
+            owner = self._owner_prefix + uuid.uuid4().hex[:8]
+            with self._conn:
+                claimed = self._conn.execute(
+                    "UPDATE jobs SET state = 'running', owner = ?, lease_until = ?, updated_at = ?"
+                    " WHERE job_id = ? AND stage = ? AND state = 'queued' AND updated_at = ?",
+                    (owner, now + self.lease_seconds, now, row[0], stage, row[2])).rowcount
+            if claimed:
+                self._claims.add(owner)
+                return row[0], json.loads(row[1]), owner
+
+    def _finish(self, job_id: str, stage: str, args: dict, owner: str):
+        index = self.stage_names.index(stage)
+        now = time.time()
+        with self._cond:
+            self._claims.discard(owner)
+            with self._conn:
+                if index + 1 < len(self.stage_names):
+                    updated = self._conn.execute(
+                        "UPDATE jobs SET stage = ?, state = 'queued', args = ?, attempts = 0, next_run_at = ?, updated_at = ?,"
+                        " owner = NULL, lease_until = NULL WHERE job_id = ? AND owner = ? AND state = 'running'",
+                        (self.stage_names[index + 1], json.dumps(args, ensure_ascii=False), now, now, job_id, owner)).rowcount
+                else:
+                    updated = self._conn.execute(
+                        "UPDATE jobs SET state = 'done', args = ?, updated_at = ?, owner = NULL, lease_until = NULL"
+                        " WHERE job_id = ? AND owner = ? AND state = 'running'",
+                        (json.dumps(args, ensure_ascii=False), now, job_id, owner)).rowcount
+                    if updated:
+                        self._conn.execute('DELETE FROM job_pages WHERE job_id = ?', (job_id,))
+            self._cond.notify_all()
+        if not updated:
+            logging.warning(f'ingest job lease lost, result dropped, job_id={job_id}, stage={stage}')
+
+    def _fail(self, job_id: str, stage: str, args: dict, error: str, owner: str) -> bool:
+        now = time.time()
+        with self._cond:
+            self._claims.discard(owner)
+            row = self._conn.execute("SELECT attempts FROM jobs WHERE job_id = ? AND owner = ? AND state = 'running'",
+                                     (job_id, owner)).fetchone()
+            if row is None:
+                logging.warning(f'ingest job lease lost, failure dropped, job_id={job_id}, stage={stage}, error={error}')
+                return False
+            attempts = row[0] + 1
+            give_up = attempts >= self.max_attempts
+            with self._conn:
+                if give_up:
+                    self._conn.execute(
+                        "UPDATE jobs SET state = 'failed', attempts = ?, last_error = ?, updated_at = ?,"
+                        " owner = NULL, lease_until = NULL WHERE job_id = ? AND owner = ?",
+                        (attempts, error, now, job_id, owner))
+                else:
+                    next_run_at = now + self.backoff_seconds * (2 ** (attempts - 1))
+                    self._conn.execute(
+                        "UPDATE jobs SET state = 'queued', attempts = ?, last_error = ?, next_run_at = ?, updated_at = ?,"
+                        " owner = NULL, lease_until = NULL WHERE job_id = ? AND owner = ?",
+                        (attempts, error, next_run_at, now, job_id, owner))
+            self._cond.notify_all()
+        logging.error(f'ingest job failed, job_id={job_id}, stage={stage}, attempts={attempts}, give_up={give_up}, error={error}')
+        return give_up
+
+    def _requeue_expired(self) -> int:
+        # 租约过期说明领取它的进程已经退出, 重新排队, 从记录的进度继续; 老数据没有租约也算过期
+        now = time.time()
+        with self._conn:
+            return self._conn.execute(
+                "UPDATE jobs SET state = 'queued', next_run_at = ?, updated_at = ?, owner = NULL, lease_until = NULL"
+                " WHERE state = 'running' AND (lease_until IS NULL OR lease_until < ?)", (now, now, now)).rowcount
+
+    def _heartbeat(self):
+        while True:
+            with self._cond:
+                self._cond.wait(timeout=self.lease_seconds / 3)
+                if self._stopping:
+                    return
+                now = time.time()
+                with self._conn:
+                    self._conn.executemany("UPDATE jobs SET lease_until = ? WHERE owner = ? AND state = 'running'",
+                                           [(now + self.lease_seconds, owner) for owner in self._claims])
+                cnt = self._requeue_expired()
+                if cnt:
+                    self._cond.notify_all()
+            if cnt:
+                logging.info(f'requeue {cnt} ingest jobs with expired lease')
+
+    def _worker(self, stage: str, handler: Callable[[str, dict], Optional[dict]]):
+        while True:
+            with self._cond:
+                claimed = None
+                while not self._stopping:
+                    claimed = self._claim(stage)
+                    if claimed:
+                        break
+                    # 等待新任务, 超时再检查是否有到期的重试
+                    self._cond.wait(timeout=1.0)
+                if self._stopping:
+                    return
+            job_id, args, owner = claimed
+            try:
+                with metrics.span('ingest_stage', stage=stage):
+                    new_args = handler(job_id, args)
+            except Exception as e:
+                stage_failures.inc(stage=stage)
+                logging.exception(f'ingest stage error, job_id={job_id}, stage={stage}')
+                if self._fail(job_id, stage, args, str(e), owner) and self.on_failed:
+                    self.on_failed(job_id, stage, args, str(e))
+                continue
+            self._finish(job_id, stage, new_args if new_args is not None else args, owner)
+
+    def start(self):
+        with self._lock:
+            # 只接管租约过期的任务, 其他进程还在执行的不动
+            cnt = self._requeue_expired()
+        if cnt:
+            logging.info(f'resume {cnt} interrupted ingest jobs')
+        t = threading.Thread(target=self._heartbeat, name='ingest-heartbeat', daemon=True)
+        t.start()
+        self._threads.append(t)
+        for name, handler, workers in self.stages:
+            for i in range(workers):
+                t = threading.Thread(target=self._worker, args=(name, handler), name=f'ingest-{name}-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
@@ -0,0 +1,246 @@
+import os
+import re
+import json
+import math
+import logging
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+_token_pattern = re.compile(r'[a-z0-9]+|[\u4e00-\u9fff]+')
+
+
+def tokenize(text: str) -> List[str]:
+    """English words / numbers as whole tokens, Chinese runs as character bigrams."""
+    tokens = []
+    for m in _token_pattern.finditer(text.lower()):
+        w = m.group()
+        if '\u4e00' <= w[0] <= '\u9fff':
+            if len(w) == 1:
+                tokens.append(w)
+            else:
+                tokens.extend(w[i : i + 2] for i in range(len(w) - 1))
+        else:
+            tokens.append(w)
+    return tokens
+
+
+class _LexDoc:
+    def __init__(self, path: str):
+        self.path = path
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self.lengths: Dict[str, int] = {}
+        self.pages: Dict[str, str] = {}
+        # chunk 在页面中的 (start, end), 早期的记录没有
+        self.spans: Dict[str, Tuple[Optional[int], Optional[int]]] = {}
+        self.terms: Dict[str, List[str]] = {}
+        self.total_len = 0
+        # 已读到的位置和文件 inode, 日志里的记录条数 (包括已删除/被覆盖的)
+        self.offset = 0
+        self.inode = None
+        self.records = 0
+
+    def refresh(self):
+        # 读入其他进程追加的记录; 文件被压缩替换或删除后整个重新加载
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            if self.inode is not None:
+                self._reset()
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                self._reset()
+                self.inode = st.st_ino
+            if st.st_size == self.offset:
+                return
+            f.seek(self.offset)
+            data = f.read()
+        # 只处理完整的行, 其他进程写了一半的留到下次
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            self.records += 1
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f'skip broken lexical index line, file={self.path}')
+                continue
+            if record.get('del'):
+                self._remove(record['id'])
+            else:
+                self._add(record['id'], record['p'], record['tf'], (record.get('s'), record.get('e')))
+        self.offset += end
+
+    def _add(self, chunk_id: str, page_index: str, tf: Dict[str, int], span=(None, None)):
+        if chunk_id in self.lengths:
+            self._remove(chunk_id)
+        for term, cnt in tf.items():
+            self.postings[term][chunk_id] = cnt
+        length = sum(tf.values())
+        self.lengths[chunk_id] = length
+        self.pages[chunk_id] = page_index
+        self.spans[chunk_id] = span
+        self.terms[chunk_id] = list(tf.keys())
+        self.total_len += length
+
+    def _remove(self, chunk_id: str):
+        if chunk_id not in self.lengths:
+            return
+        for term in self.terms.pop(chunk_id):
+            del self.postings[term][chunk_id]
+            if not self.postings[term]:
+                del self.postings[term]
+        self.total_len -= self.lengths.pop(chunk_id)
+        self.pages.pop(chunk_id, None)
+        self.spans.pop(chunk_id, None)
+
+    def _append(self, lines: List[str]):
+        # 不移动 offset, 下次 refresh 会把自己写的记录再读一遍, 重复应用结果不变
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _record(self, chunk_id: str) -> str:
+        tf = {term: self.postings[term][chunk_id] for term in self.terms[chunk_id]}
+        record = {'id': chunk_id, 'p': self.pages[chunk_id], 'tf': tf}
+        start, end = self.spans[chunk_id]
+        if start is not None:
+            record['s'], record['e'] = start, end
+        return json.dumps(record, ensure_ascii=False)
+
+    def add(self, chunks: List[Tuple[str, str, str, int, int]]):
+        lines = []
+        for chunk_id, page_index, text, start, end in chunks:
+            if chunk_id in self.lengths:
+                continue
+            self._add(chunk_id, page_index, dict(Counter(tokenize(text))), (start, end))
+            lines.append(self._record(chunk_id))
+        if lines:
+            self._append(lines)
+        elif not os.path.exists(self.path):
+            open(self.path, 'a').close()
+        return len(lines)
+
+    def remove(self, chunk_ids: List[str]):
+        lines = []
+        for chunk_id in chunk_ids:
+            if chunk_id in self.lengths:
+                self._remove(chunk_id)
+                lines.append(json.dumps({'id': chunk_id, 'del': 1}))
+        if lines:
+            self._append(lines)
+
+    def compact(self, min_garbage_ratio: float):
+        # 和 PageStore.compact 一样: 删除/覆盖的记录占到一定比例后, 只保留有效的记录重写日志
+        self.refresh()
+        records = self.records
+        if not records or 1 - len(self.lengths) / records < min_garbage_ratio:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for chunk_id in self.lengths:
+                f.write(self._record(chunk_id) + '\n')
+        os.replace(tmp_path, self.path)
+        st = os.stat(self.path)
+        self.inode, self.offset, self.records = st.st_ino, st.st_size, len(self.lengths)
+        logging.info(f'compacted lexical index, file={self.path}, records={records} -> {self.records}')
+
+
+class LexicalIndex:
+    """Per-document BM25 inverted index over Chinese character bigrams and English words.
+
+    Each document is persisted as an append-only `<root>/<file_id>.lex` log, so
+    chunks can be added or removed incrementally; loaded documents pick up what
+    other processes append, and the log is compacted once removals pile up.
+    """
+
+    def __init__(self, root_dir: str, max_loaded_docs: int = 256, k1: float = 1.5, b: float = 0.75):
+        self.root_dir = root_dir
+        self.max_loaded_docs = max_loaded_docs
+        self.k1 = k1
+        self.b = b
+        self._docs: OrderedDict[str, _LexDoc] = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _path(self, file_id: str) -> str:
+        return os.path.join(self.root_dir, f'{file_id}.lex')
+
+    def _get_doc(self, file_id: str, create: bool = False) -> Optional[_LexDoc]:
+        # 不存在的文档不缓存, 否则看不到其他进程之后写入的内容
+        doc = self._docs.get(file_id)
+        if doc is None:
+            if not create and not os.path.exists(self._path(file_id)):
+                return None
+            doc = _LexDoc(self._path(file_id))
+            self._docs[file_id] = doc
+            while len(self._docs) > self.max_loaded_docs:
+                self._docs.popitem(last=False)
+        else:
+            doc.refresh()
+        self._docs.move_to_end(file_id)
+        return doc
+
+    def has_doc(self, file_id: str) -> bool:
+        return os.path.exists(self._path(file_id))
+
+    def add(self, file_id: str, chunks: List[Tuple[str, str, str, int, int]]) -> int:
+        """chunks: (chunk_id, page_index, text, start, end), start/end are the chunk's offsets
+        in the page; chunks already indexed are skipped."""
+        with self._lock:
+            return self._get_doc(file_id, create=True).add(chunks)
+
+    def remove(self, file_id: str, chunk_ids: List[str]):
+        with self._lock:
+            doc = self._get_doc(file_id)
+            if doc is not None:
+                doc.remove(chunk_ids)
+
+    def remove_pages(self, file_id: str, page_keys: List[str], min_garbage_ratio: float = 0.5):
+        with self._lock:
+            doc = self._get_doc(file_id)
+            if doc is None:
+                return
+            page_keys = set(page_keys)
+            doc.remove([chunk_id for chunk_id, page_index in doc.pages.items() if page_index in page_keys])
+            doc.compact(min_garbage_ratio)
+
+    def drop(self, file_id: str):
+        with self._lock:
+            self._docs.pop(file_id, None)
+            if os.path.exists(self._path(file_id)):
+                os.remove(self._path(file_id))
+
+    def search(self, file_id_list: List[str], query_str: str, top_k: int) -> List[Tuple[str, str, str, float, tuple]]:
+        """Return [(file_id, page_index, chunk_id, score, (start, end))] sorted by BM25 score;
+        start/end are None for chunks indexed before offsets were recorded."""
+        terms = set(tokenize(query_str))
+        if not terms:
+            return []
+        with self._lock:
+            docs = [(file_id, self._get_doc(file_id)) for file_id in file_id_list]
+            docs = [(file_id, doc) for file_id, doc in docs if doc is not None]
+            n = sum(len(doc.lengths) for _, doc in docs)
+            if n == 0:
+                return []
+            avgdl = sum(doc.total_len for _, doc in docs) / n
+
+            scores = defaultdict(float)
+            for term in terms:
+                df = sum(len(doc.postings.get(term, ())) for _, doc in docs)
+                if df == 0:
+                    continue
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for file_id, doc in docs:
+                    for chunk_id, tf in doc.postings.get(term, {}).items():
+                        norm = self.k1 * (1 - self.b + self.b * doc.lengths[chunk_id] / avgdl)
+                        scores[(file_id, chunk_id)] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+            best = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:top_k]
+            doc_by_id = dict(docs)
+            return [(file_id, doc_by_id[file_id].pages[chunk_id], chunk_id, score, doc_by_id[file_id].spans[chunk_id])
+                    for (file_id, chunk_id), score in best]
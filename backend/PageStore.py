@@ -0,0 +1,287 @@
+import os
+import glob
+import json
+import mmap
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODEC_RAW = 0
+CODEC_ZSTD = 1
+
+
+def _index_record(page_key: str, offset: int, length: int, codec: int, attrs: Optional[dict]) -> str:
+    record = {'k': page_key, 'o': offset, 'n': length, 'z': codec}
+    if attrs is not None:
+        record['a'] = attrs
+    return json.dumps(record, ensure_ascii=False)
+
+
+class _PackedDoc:
+    def __init__(self, data_path: str, index_path: str):
+        # data_path 是没有头部的老索引对应的数据文件; compact 后索引第一行 {"data": ..., "g": ...} 指明数据文件
+        self.default_data_path = data_path
+        self.index_path = index_path
+        self._file = None
+        self._mmap = None
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.close()
+        # page_key -> (offset, length, codec, attrs), 同一个 key 以最后一次写入为准
+        self.index: Dict[str, Tuple[int, int, int, Optional[dict]]] = {}
+        self.data_path = self.default_data_path
+        self.generation = 0
+        self.size = 0
+        # 已读到的索引位置和索引文件 inode
+        self.offset = 0
+        self.inode = None
+
+    def refresh(self):
+        # 读入其他进程追加的索引; 索引被 compact 换掉或被删除时整个重新加载
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            if self.inode is not None:
+                self._reset()
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                self._reset()
+                self.inode = st.st_ino
+            if st.st_size > self.offset:
+                f.seek(self.offset)
+                data = f.read()
+                # 只处理完整的行, 其他进程写了一半的留到下次
+                end = data.rfind(b'\n') + 1
+                for line in data[:end].splitlines():
+                    self._apply(line)
+                self.offset += end
+        if os.path.exists(self.data_path):
+            self.size = os.path.getsize(self.data_path)
+
+    def _apply(self, line: bytes):
+        if not line.strip():
+            return
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # 写到一半崩溃留下的残行
+            logging.warning(f'skip broken page index line, file={self.index_path}')
+            return
+        if 'data' in record:
+            self.data_path = os.path.join(os.path.dirname(self.index_path), record['data'])
+            self.generation = record['g']
+        elif record.get('d'):
+            self.index.pop(record['k'], None)
+        else:
+            self.index[record['k']] = (record['o'], record['n'], record['z'], record.get('a'))
+
+    def read(self, offset: int, length: int) -> bytes:
+        if length == 0:
+            return b''
+        if self._mmap is None or len(self._mmap) < offset + length:
+            self.close()
+            self._file = open(self.data_path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[offset : offset + length]
+
+    def append(self, page_key: str, data: bytes, codec: int, attrs: Optional[dict] = None):
+        with open(self.data_path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+        # 不移动 offset, 下次 refresh 会把自己写的记录再读一遍, 重复应用结果不变
+        with open(self.index_path, 'a') as f:
+            f.write(_index_record(page_key, offset, len(data), codec, attrs) + '\n')
+        self.index[page_key] = (offset, len(data), codec, attrs)
+        self.size = offset + len(data)
+
+    def remove(self, page_keys: List[str]):
+        # 追加删除标记, 数据文件里的内容在 compact 时回收
+        lines = [json.dumps({'k': key, 'd': 1}, ensure_ascii=False) for key in page_keys if key in self.index]
+        if lines:
+            with open(self.index_path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        for key in page_keys:
+            self.index.pop(key, None)
+
+    def live_bytes(self) -> int:
+        return sum(length for _, length, _, _ in self.index.values())
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PageStore:
+    """One packed data file plus an append-only offset index per document.
+
+    Replaces the old `<root>/<file_id>/<page_key>.txt` layout, which is
+    migrated the first time a document is opened. Reads are served from mmap.
+    Compaction writes a new generation of the data file and switches to it by
+    replacing the index, whose header names its data file; open documents
+    notice appends and replacements made by other processes.
+    """
+
+    def __init__(self, root_dir: str, compress: bool = False, max_open_docs: int = 256):
+        self.root_dir = root_dir
+        self.compress = compress and zstandard is not None
+        if compress and zstandard is None:
+            logging.warning('zstandard is not installed, pages are stored uncompressed')
+        self.max_open_docs = max_open_docs
+        self._docs: OrderedDict[str, _PackedDoc] = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _paths(self, file_id: str) -> Tuple[str, str]:
+        base = os.path.join(self.root_dir, f'{file_id}.pages')
+        return base, base + '.idx'
+
+    def _legacy_dir(self, file_id: str) -> str:
+        return os.path.join(self.root_dir, file_id)
+
+    def _encode(self, page_text: str) -> Tuple[bytes, int]:
+        data = page_text.encode('utf-8')
+        if self.compress:
+            return zstandard.ZstdCompressor().compress(data), CODEC_ZSTD
+        return data, CODEC_RAW
+
+    def _decode(self, data: bytes, codec: int) -> str:
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError('page is zstd compressed but zstandard is not installed')
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return data.decode('utf-8')
+
+    def _migrate_legacy(self, file_id: str, doc: _PackedDoc):
+        legacy_dir = self._legacy_dir(file_id)
+        names = [name for name in os.listdir(legacy_dir) if name.endswith('.txt')]
+        for name in names:
+            with open(os.path.join(legacy_dir, name), 'r') as f:
+                data, codec = self._encode(f.read())
+            doc.append(name[:-len('.txt')], data, codec)
+        shutil.rmtree(legacy_dir)
+        logging.info(f'migrated page dir to packed store, file_id={file_id}, pages={len(names)}')
+
+    def _get_doc(self, file_id: str) -> _PackedDoc:
+        doc = self._docs.get(file_id)
+        if doc is not None:
+            doc.refresh()
+            self._docs.move_to_end(file_id)
+            return doc
+
+        data_path, index_path = self._paths(file_id)
+        doc = _PackedDoc(data_path, index_path)
+        if not doc.index and os.path.isdir(self._legacy_dir(file_id)):
+            self._migrate_legacy(file_id, doc)
+
+        # 不存在的文档不缓存, 之后其它进程写入了也能读到
+        if doc.index:
+            self._cache_doc(file_id, doc)
+        return doc
+
+    def _cache_doc(self, file_id: str, doc: _PackedDoc):
+        self._docs[file_id] = doc
+        while len(self._docs) > self.max_open_docs:
+            _, evicted = self._docs.popitem(last=False)
+            evicted.close()
+
+    def save_page(self, file_id: str, page_key: str, page_text: str, attrs: Optional[dict] = None):
+        data, codec = self._encode(page_text)
+        with self._lock:
+            doc = self._get_doc(file_id)
+            doc.append(page_key, data, codec, attrs)
+            if file_id not in self._docs:
+                self._cache_doc(file_id, doc)
+
+    def load_page(self, file_id: str, page_key: str) -> Optional[str]:
+        with self._lock:
+            doc = self._get_doc(file_id)
+            entry = doc.index.get(page_key)
+            if entry is None:
+                return None
+            offset, length, codec, _ = entry
+            data = doc.read(offset, length)
+        return self._decode(data, codec)
+
+    def page_attrs(self, file_id: str, page_key: str) -> Optional[dict]:
+        # 入库时预先算好的页面属性, 老数据没有则返回 None
+        with self._lock:
+            entry = self._get_doc(file_id).index.get(page_key)
+        return entry[3] if entry is not None else None
+
+    def page_keys(self, file_id: str) -> List[str]:
+        with self._lock:
+            return list(self._get_doc(file_id).index.keys())
+
+    def delete_pages(self, file_id: str, page_keys: List[str]):
+        with self._lock:
+            self._get_doc(file_id).remove(page_keys)
+
+    def compact(self, file_id: str, min_garbage_ratio: float = 0.5):
+        """Rewrite the packed file without overwritten/deleted pages once they make up min_garbage_ratio of it."""
+        with self._lock:
+            doc = self._get_doc(file_id)
+            if not doc.size or 1 - doc.live_bytes() / doc.size < min_garbage_ratio:
+                return
+            _, index_path = self._paths(file_id)
+            generation = doc.generation + 1
+            data_name = f'{file_id}.pages.{generation}'
+            data_path = os.path.join(self.root_dir, data_name)
+            size = 0
+            with open(data_path, 'wb') as data_f, open(index_path + '.tmp', 'w') as index_f:
+                index_f.write(json.dumps({'data': data_name, 'g': generation}) + '\n')
+                for key, (offset, length, codec, attrs) in doc.index.items():
+                    data_f.write(doc.read(offset, length))
+                    index_f.write(_index_record(key, size, length, codec, attrs) + '\n')
+                    size += length
+                data_f.flush()
+                os.fsync(data_f.fileno())
+                index_f.flush()
+                os.fsync(index_f.fileno())
+            # 替换索引是唯一的切换点, 崩溃时要么还是旧的一对, 要么是新的一对
+            os.replace(index_path + '.tmp', index_path)
+            doc.close()
+            if doc.data_path != data_path and os.path.exists(doc.data_path):
+                os.remove(doc.data_path)
+            logging.info(f'compacted page store, file_id={file_id}, size={doc.size} -> {size}, generation={generation}')
+            self._docs.pop(file_id, None)
+
+    def drop(self, file_id: str):
+        # 删除整个文档的页面, 包括各代数据文件
+        with self._lock:
+            doc = self._docs.pop(file_id, None)
+            if doc is not None:
+                doc.close()
+            for path in glob.glob(os.path.join(glob.escape(self.root_dir), glob.escape(f'{file_id}.pages') + '*')):
+                os.remove(path)
+            if os.path.isdir(self._legacy_dir(file_id)):
+                shutil.rmtree(self._legacy_dir(file_id))
+
+    def version(self, file_id: str) -> Optional[tuple]:
+        """Changes whenever any process saves, deletes, compacts or drops the document's pages; None if it has no pages."""
+        # 每次写入都会追加索引, 压缩会替换索引, 看索引文件的 inode/大小/修改时间就够了
+        _, index_path = self._paths(file_id)
+        try:
+            st = os.stat(index_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def has_doc(self, file_id: str) -> bool:
+        data_path, index_path = self._paths(file_id)
+        return os.path.exists(index_path) or os.path.exists(data_path) or os.path.isdir(self._legacy_dir(file_id))
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+
+class _Entries:
+    def __init__(self, dim: int):
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.queries: List[str] = []
+        self.values: List[Any] = []
+
+
+class SemanticCache:
+    """Near-duplicate query cache: query embeddings per document set, matched by cosine similarity.
+
+    Each document set keeps at most `max_entries_per_set` entries (oldest evicted
+    first) and at most `max_sets` sets are kept (least recently used evicted).
+    Callers pass the documents' current version, so entries cached before another
+    process re-ingested or deleted a document are never matched again.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_sets: int = 1000, max_entries_per_set: int = 256):
+        self.threshold = threshold
+        self.max_sets = max_sets
+        self.max_entries_per_set = max_entries_per_set
+        self._sets: OrderedDict[tuple, _Entries] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _set_key(file_id_list: List[str], version: Any = None) -> tuple:
+        return tuple(sorted(file_id_list)), version
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        v = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm > 0 else v
+
+    def get(self, file_id_list: List[str], embedding, version: Any = None) -> Optional[Tuple[str, Any]]:
+        """Return (earlier query, value) of the most similar earlier query, or None."""
+        v = self._normalize(embedding)
+        key = self._set_key(file_id_list, version)
+        with self._lock:
+            entries = self._sets.get(key)
+            if entries is None or not entries.queries or entries.matrix.shape[1] != v.shape[0]:
+                self.misses += 1
+                return None
+            self._sets.move_to_end(key)
+            scores = entries.matrix @ v
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entries.queries[best], entries.values[best]
+
+    def put(self, file_id_list: List[str], embedding, query_str: str, value: Any, version: Any = None):
+        v = self._normalize(embedding)
+        key = self._set_key(file_id_list, version)
+        with self._lock:
+            entries = self._sets.get(key)
+            if entries is None or entries.matrix.shape[1] != v.shape[0]:
+                entries = _Entries(v.shape[0])
+                self._sets[key] = entries
+            self._sets.move_to_end(key)
+
+            entries.matrix = np.vstack([entries.matrix, v[None, :]])
+            entries.queries.append(query_str)
+            entries.values.append(value)
+            if len(entries.queries) > self.max_entries_per_set:
+                overflow = len(entries.queries) - self.max_entries_per_set
+                entries.matrix = entries.matrix[overflow:]
+                entries.queries = entries.queries[overflow:]
+                entries.values = entries.values[overflow:]
+
+            while len(self._sets) > self.max_sets:
+                self._sets.popitem(last=False)
+
+    def invalidate(self, file_id: str):
+        with self._lock:
+            for key in [key for key in self._sets if file_id in key[0]]:
+                del self._sets[key]
@@ -0,0 +1,134 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+try:
+    import redis
+    import redis.asyncio as aioredis
+except ImportError:
+    redis = None
+    aioredis = None
+
+
+FINISHED_STATUS = '完成'
+
+
+class LocalStatusBroker:
+    """Process-local task status with async subscribers woken on every change.
+
+    `set` may be called from any thread (background tasks run in the threadpool);
+    subscribers get `None` as a heartbeat when nothing changed for a while.
+    Finished tasks are dropped after `finished_ttl` seconds.
+    """
+
+    def __init__(self, finished_ttl: int = 600):
+        self.finished_ttl = finished_ttl
+        self._status: Dict[str, Tuple[str, float]] = {}
+        self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _cleanup(self, now: float):
+        expired = [file_id for file_id, (status, updated_at) in self._status.items()
+                   if status == FINISHED_STATUS and now - updated_at > self.finished_ttl]
+        for file_id in expired:
+            del self._status[file_id]
+
+    def set(self, file_id: str, status: str):
+        now = time.time()
+        with self._lock:
+            self._status[file_id] = (status, now)
+            self._cleanup(now)
+            subscribers = list(self._subscribers.get(file_id, []))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, status)
+
+    def get(self, file_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._status.get(file_id)
+        return entry[0] if entry else None
+
+    async def aget(self, file_id: str) -> Optional[str]:
+        return self.get(file_id)
+
+    async def subscribe(self, file_id: str, heartbeat: float = 15) -> AsyncIterator[Optional[str]]:
+        entry = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers[file_id].append(entry)
+            current = self._status.get(file_id)
+        try:
+            status = current[0] if current else None
+            if status is not None:
+                yield status
+            while status != FINISHED_STATUS:
+                try:
+                    status = await asyncio.wait_for(entry[1].get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield status
+        finally:
+            with self._lock:
+                self._subscribers[file_id].remove(entry)
+                if not self._subscribers[file_id]:
+                    del self._subscribers[file_id]
+
+
+class RedisStatusBroker:
+    """Same interface as LocalStatusBroker, shared by all uvicorn workers through redis."""
+
+    def __init__(self, redis_url: str, finished_ttl: int = 600, ttl: int = 86400, prefix: str = 'task_status'):
+        if redis is None:
+            raise ImportError('redis is required for RedisStatusBroker, pip install redis')
+        self.redis_url = redis_url
+        self.finished_ttl = finished_ttl
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(redis_url, decode_responses=True)
+
+    def _key(self, file_id: str) -> str:
+        return f'{self.prefix}:{file_id}'
+
+    def set(self, file_id: str, status: str):
+        ttl = self.finished_ttl if status == FINISHED_STATUS else self.ttl
+        pipe = self._client.pipeline()
+        pipe.set(self._key(file_id), status, ex=ttl)
+        pipe.publish(self._key(file_id), status)
+        pipe.execute()
+
+    def get(self, file_id: str) -> Optional[str]:
+        return self._client.get(self._key(file_id))
+
+    async def aget(self, file_id: str) -> Optional[str]:
+        # 同步客户端的请求放到线程里, 不阻塞事件循环
+        return await asyncio.to_thread(self.get, file_id)
+
+    async def subscribe(self, file_id: str, heartbeat: float = 15) -> AsyncIterator[Optional[str]]:
+        client = aioredis.Redis.from_url(self.redis_url, decode_responses=True)
+        pubsub = client.pubsub()
+        try:
+            # 先订阅再读当前状态, 避免中间的变更丢失
+            await pubsub.subscribe(self._key(file_id))
+            status = await client.get(self._key(file_id))
+            if status is not None:
+                yield status
+            while status != FINISHED_STATUS:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=heartbeat)
+                if message is None:
+                    yield None
+                    continue
+                status = message['data']
+                yield status
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.close()
+            await client.close()
+
+
+def create_status_broker(redis_url: Optional[str] = None):
+    if redis_url:
+        logging.info(f'using redis status broker, url={redis_url}')
+        return RedisStatusBroker(redis_url)
+    return LocalStatusBroker()
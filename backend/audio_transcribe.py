@@ -0,0 +1,139 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import requests
+
+import config
+
+# 转写接口可以换成本地服务 (测试时用本地的替身), 需要兼容 openai 的 /v1/audio/transcriptions
+TRANSCRIBE_URL = getattr(config, 'AUDIO_TRANSCRIBE_URL', 'https://api.openai.com/v1/audio/transcriptions')
+TRANSCRIBE_MODEL = getattr(config, 'AUDIO_TRANSCRIBE_MODEL', 'whisper-1')
+SEGMENT_SECONDS = getattr(config, 'AUDIO_SEGMENT_SECONDS', 300)
+CONCURRENCY = getattr(config, 'AUDIO_TRANSCRIBE_CONCURRENCY', 4)
+MAX_ATTEMPTS = getattr(config, 'AUDIO_TRANSCRIBE_MAX_ATTEMPTS', 3)
+REQUEST_TIMEOUT = 600
+
+AUDIO_EXTS = ['.mp3', '.mp4', '.m4a', '.wav']
+
+
+def is_audio(local_file_path):
+    return any(local_file_path.lower().endswith(ext) for ext in AUDIO_EXTS)
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def probe_duration(local_file_path) -> Optional[float]:
+    # 需要 ffmpeg, 没有安装时返回 None, 整个文件作为一段转写
+    if shutil.which('ffprobe') is None:
+        return None
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
+         local_file_path], capture_output=True, text=True)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        logging.warning(f'ffprobe failed, file={local_file_path}, error={result.stderr[-500:]}')
+        return None
+
+
+def plan_segments(duration: Optional[float], segment_seconds: float = SEGMENT_SECONDS) -> List[Tuple[float, Optional[float]]]:
+    if not duration:
+        return [(0, None)]
+    segments = []
+    start = 0.0
+    while start < duration:
+        segments.append((start, min(start + segment_seconds, duration)))
+        start += segment_seconds
+    return segments
+
+
+def cut_segment(local_file_path, start, end, out_dir) -> str:
+    # 只保留单声道 16k 音频, 每段远小于接口的文件大小限制
+    out_path = os.path.join(out_dir, f'{int(start)}.mp3')
+    subprocess.run(
+        ['ffmpeg', '-v', 'error', '-y', '-ss', str(start), '-t', str(end - start), '-i', local_file_path,
+         '-vn', '-ac', '1', '-ar', '16000', '-b:a', '32k', out_path], check=True, capture_output=True)
+    return out_path
+
+
+def transcribe_file(segment_path) -> str:
+    headers = {
+        'Authorization': f'Bearer {os.environ["OPENAI_API_KEY"]}',
+    }
+    data = {
+        'model': TRANSCRIBE_MODEL,
+    }
+    with open(segment_path, 'rb') as f:
+        response = requests.post(TRANSCRIBE_URL, headers=headers, data=data, files={'file': f}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['text']
+
+
+def _segment_cache_path(cache_dir, start, end):
+    return os.path.join(cache_dir, f'{int(start)}-{"all" if end is None else int(end)}.txt')
+
+
+def _transcribe_segment(local_file_path, start, end, out_dir, transcribe_fn, cache_dir=None) -> str:
+    # 转写过的段落结果落盘, 任务重试时直接读取, 只重新转写失败的段
+    cache_path = _segment_cache_path(cache_dir, start, end) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            return f.read()
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            segment_path = local_file_path if end is None else cut_segment(local_file_path, start, end, out_dir)
+            text = transcribe_fn(segment_path)
+            break
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            logging.warning(f'transcribe segment failed, start={start}, attempt={attempt}, error={e}')
+            time.sleep(2 ** attempt)
+    if cache_path:
+        with open(cache_path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(cache_path + '.tmp', cache_path)
+    return text
+
+
+def page_header(start, end):
+    if end is None:
+        return ''
+    return f'[{format_seconds(start)}-{format_seconds(end)}]\n'
+
+
+def transcribe_pages(local_file_path, transcribe_fn: Optional[Callable[[str], str]] = None,
+                     segment_seconds: float = SEGMENT_SECONDS, concurrency: int = CONCURRENCY,
+                     cache_dir: Optional[str] = None) -> Iterator[Tuple[int, int, str]]:
+    """Transcribe audio in time segments, in parallel, and yield (done, total, page) in segment order.
+
+    Each page starts with its time range, e.g. `[00:05:00-00:10:00]`. transcribe_fn(segment_path) -> text
+    defaults to the configured transcription endpoint. With cache_dir, finished segments are kept
+    there by time range and reused by the next call instead of being transcribed again.
+    """
+    transcribe_fn = transcribe_fn or transcribe_file
+    segments = plan_segments(probe_duration(local_file_path), segment_seconds)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cached = sum(os.path.exists(_segment_cache_path(cache_dir, start, end)) for start, end in segments)
+    else:
+        cached = 0
+    logging.info(f'transcribe audio, file={local_file_path}, segments={len(segments)}, cached={cached}')
+    with tempfile.TemporaryDirectory() as out_dir, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(_transcribe_segment, local_file_path, start, end, out_dir, transcribe_fn, cache_dir)
+                   for start, end in segments]
+        try:
+            for i, ((start, end), future) in enumerate(zip(segments, futures)):
+                yield i + 1, len(segments), page_header(start, end) + future.result()
+        finally:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,114 @@
+"""Compare ChineseRecursiveTextSplitter with the previous LangChain based implementation.
+
+    python bench_splitter.py [txt files...]
+
+Without arguments a synthetic Chinese document is used. Both splitters must return
+the same chunks; timings for the page split (chunk_size=1000) and the chunk split
+(chunk_size=150) used at ingest are printed as one json line.
+"""
+import re
+import sys
+import json
+import time
+import random
+from typing import List
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from ChineseRecursiveTextSplitter import ChineseRecursiveTextSplitter
+
+
+def _split_text_with_regex_from_end(text: str, separator: str, keep_separator: bool) -> List[str]:
+    if separator:
+        if keep_separator:
+            _splits = re.split(f"({separator})", text)
+            splits = ["".join(i) for i in zip(_splits[0::2], _splits[1::2])]
+            if len(_splits) % 2 == 1:
+                splits += _splits[-1:]
+        else:
+            splits = re.split(separator, text)
+    else:
+        splits = list(text)
+    return [s for s in splits if s != ""]
+
+
+class LegacyChineseRecursiveTextSplitter(RecursiveCharacterTextSplitter):
+    # 改写之前的实现, 只用于对比
+    def __init__(self, **kwargs):
+        super().__init__(keep_separator=True, **kwargs)
+        self._separators = ["\n\n", "。|！|？", "\.\s|\!\s|\?\s", "；|;\s", "，|,\s"]
+
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        final_chunks = []
+        separator = separators[-1]
+        new_separators = []
+        for i, _s in enumerate(separators):
+            if _s == "":
+                separator = _s
+                break
+            if re.search(_s, text):
+                separator = _s
+                new_separators = separators[i + 1:]
+                break
+
+        splits = _split_text_with_regex_from_end(text, separator, True)
+        _good_splits = []
+        for s in splits:
+            if self._length_function(s) < self._chunk_size:
+                _good_splits.append(s)
+            else:
+                if _good_splits:
+                    final_chunks.extend(self._merge_splits(_good_splits, ""))
+                    _good_splits = []
+                if not new_separators:
+                    final_chunks.append(s)
+                else:
+                    final_chunks.extend(self._split_text(s, new_separators))
+        if _good_splits:
+            final_chunks.extend(self._merge_splits(_good_splits, ""))
+        return [re.sub(r"\n{2,}", "\n", chunk.strip()) for chunk in final_chunks if chunk.strip() != ""]
+
+
+def synthetic_text(sentences=60000, seed=0):
+    rnd = random.Random(seed)
+    chars = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+    parts = []
+    for _ in range(sentences):
+        parts.append("".join(rnd.choice(chars) for _ in range(rnd.randint(5, 30))))
+        parts.append(rnd.choice("，，。；！？"))
+        if rnd.random() < 0.1:
+            parts.append("\n\n")
+    return "".join(parts)
+
+
+def _ingest_split(splitter_cls, text):
+    # 和入库时一样: 先按 1000 字分页, 再把每页切成 150 字的 chunk
+    t0 = time.perf_counter()
+    pages = splitter_cls(chunk_size=1000).split_text(text)
+    t1 = time.perf_counter()
+    page_splitter = splitter_cls(chunk_size=150, chunk_overlap=0)
+    chunks = [chunk for page in pages for chunk in page_splitter.split_text(page)]
+    t2 = time.perf_counter()
+    return pages, chunks, t1 - t0, t2 - t1
+
+
+def main(paths):
+    texts = [open(path, 'r').read() for path in paths] or [synthetic_text()]
+    for name, text in zip(paths or ['synthetic'], texts):
+        old_pages, old_chunks, old_page_s, old_chunk_s = _ingest_split(LegacyChineseRecursiveTextSplitter, text)
+        new_pages, new_chunks, new_page_s, new_chunk_s = _ingest_split(ChineseRecursiveTextSplitter, text)
+        print(json.dumps({
+            'text': name,
+            'chars': len(text),
+            'pages': len(new_pages),
+            'chunks': len(new_chunks),
+            'same_output': old_pages == new_pages and old_chunks == new_chunks,
+            'legacy_page_s': round(old_page_s, 4),
+            'legacy_chunk_s': round(old_chunk_s, 4),
+            'page_s': round(new_page_s, 4),
+            'chunk_s': round(new_chunk_s, 4),
+        }, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,374 @@
+"""Offline benchmark of the ingestion and retrieval hot paths.
+
+    python benchmark.py [--sizes 20,100,400] [-o result.json] [--compare base.json]
+
+Everything runs in a temporary directory without network access: the corpus is a
+synthetic paginated Chinese / English text, embeddings come from the deterministic
+`hashing` backend, and the LLM proxy is a local aiohttp server that streams a fixed
+answer. Results are written as json; with --compare every metric is printed next
+to the same metric of an earlier result.
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import importlib
+import subprocess
+from typing import Dict, List
+
+from aiohttp import web as aiohttp_web
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CN_CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+EN_WORDS = ['market', 'policy', 'growth', 'model', 'network', 'energy', 'system', 'data', 'risk', 'design',
+            'capital', 'labor', 'climate', 'signal', 'protocol', 'memory', 'price', 'trade', 'index', 'theory']
+TOPICS = ['Alpha-7', 'Project Orion', 'ISO-9001', 'Helix Engine', 'Delta Fund', 'GPT4', 'Nova Grid', 'Atlas Index']
+
+FAKE_ANSWER = '根据文档内容, 这是一个用于基准测试的固定答案。The answer is streamed in small chunks. ' * 4
+
+
+# ---------------- synthetic corpus ----------------
+
+def _cn_sentence(rnd):
+    return ''.join(rnd.choice(CN_CHARS) for _ in range(rnd.randint(8, 30))) + rnd.choice('，。。；！？')
+
+
+def _en_sentence(rnd):
+    words = [rnd.choice(EN_WORDS) for _ in range(rnd.randint(6, 16))]
+    words.insert(rnd.randrange(len(words)), rnd.choice(TOPICS))
+    sentence = ' '.join(words)
+    return sentence[0].upper() + sentence[1:] + '. '
+
+
+def synthetic_doc(rnd, pages, chars_per_page=1200):
+    """A paginated document like the output of the pdf parse service: `<|startofpage|>第N页 ...`."""
+    parts = []
+    for n in range(1, pages + 1):
+        body = [f'第{n}页\n']
+        length = 0
+        while length < chars_per_page:
+            sentence = _cn_sentence(rnd) if rnd.random() < 0.6 else _en_sentence(rnd)
+            body.append(sentence)
+            length += len(sentence)
+            if rnd.random() < 0.15:
+                body.append('\n\n')
+        parts.append('<|startofpage|>' + ''.join(body))
+    return ''.join(parts)
+
+
+def vector_question(rnd):
+    return f'{rnd.choice(TOPICS)} 和 {rnd.choice(EN_WORDS)} {rnd.choice(EN_WORDS)} 的关系是什么? #{rnd.randrange(10 ** 9)}'
+
+
+def page_question(rnd, pages):
+    return f'第{rnd.randint(1, pages)}页讲了什么 #{rnd.randrange(10 ** 9)}'
+
+
+# ---------------- helpers ----------------
+
+def distribution(samples: List[float]) -> Dict[str, float]:
+    """Latency distribution in milliseconds."""
+    if not samples:
+        return {'n': 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+    return {
+        'n': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50_ms': pct(0.5),
+        'p90_ms': pct(0.9),
+        'p99_ms': pct(0.99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _install_config(work_dir, proxy_host_port, embedding_dimension):
+    # 在 config_demo 的基础上生成一份只指向临时目录的 config, 不会读写正式数据
+    bench_config = types.ModuleType('config')
+    with open(os.path.join(BACKEND_DIR, 'config_demo.py'), 'r') as f:
+        exec(compile(f.read(), 'config_demo.py', 'exec'), bench_config.__dict__)
+    bench_config.PROXY_HOST_PORT = proxy_host_port
+    bench_config.UPLOAD_HOST_PORT = 'http://127.0.0.1'
+    bench_config.API_KEY = 'benchmark'
+    bench_config.APP_NAME = 'benchmark'
+    bench_config.STATIC_DIR = os.path.join(work_dir, 'static') + '/'
+    bench_config.EMBEDDING_BACKEND = 'hashing'
+    bench_config.EMBEDDING_BACKEND_OPTIONS = {'dimension': embedding_dimension}
+    sys.modules['config'] = bench_config
+    return bench_config
+
+
+# ---------------- fake LLM proxy ----------------
+
+async def start_fake_llm(ttfb_ms: float, chunk_chars: int = 16):
+    """Local stand-in for PROXY_HOST_PORT/openai-api-proxy/chat, returns (runner, host_port)."""
+    async def chat(request):
+        data = await request.json()
+        if '判断以下输入【问题】的类别' in data['prompt']:
+            return aiohttp_web.Response(text='{"类别":"适合向量搜索的具体问题"}')
+        response = aiohttp_web.StreamResponse()
+        await response.prepare(request)
+        await asyncio.sleep(ttfb_ms / 1000)
+        for i in range(0, len(FAKE_ANSWER), chunk_chars):
+            await response.write(FAKE_ANSWER[i : i + chunk_chars].encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    app = aiohttp_web.Application()
+    app.router.add_post('/openai-api-proxy/chat', chat)
+    runner = aiohttp_web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp_web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+async def asgi_post(app, path, payload):
+    """POST json to an ASGI app in process, returns (ttfb, total, body)."""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+    }
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # 客户端一直不断开
+        await asyncio.Event().wait()
+
+    start = time.perf_counter()
+    first_at = None
+    chunks = []
+
+    async def send(message):
+        nonlocal first_at
+        if message['type'] == 'http.response.body' and message.get('body'):
+            if first_at is None:
+                first_at = time.perf_counter()
+            chunks.append(message['body'])
+
+    await app(scope, receive, send)
+    end = time.perf_counter()
+    return (first_at or end) - start, end - start, b''.join(chunks)
+
+
+# ---------------- benchmarks ----------------
+
+def bench_splitter(embedchain_util, corpus: List[str]):
+    text = ''.join(corpus)
+    start = time.perf_counter()
+    pages = embedchain_util.g_page_splitter.split_text(text.replace('<|startofpage|>', ''))
+    page_s = time.perf_counter() - start
+    start = time.perf_counter()
+    chunks = [chunk for page in text.split('<|startofpage|>') for chunk in embedchain_util.g_chunk_splitter.split_text(page)]
+    chunk_s = time.perf_counter() - start
+    return {
+        'chars': len(text),
+        'page_split_chars_per_s': round(len(text) / page_s),
+        'chunk_split_chars_per_s': round(len(text) / chunk_s),
+        'pages': len(pages),
+        'chunks': len(chunks),
+    }
+
+
+def bench_query_doc(embedchain_util, rnd, file_ids, queries):
+    single = []
+    multi = []
+    for _ in range(queries):
+        file_id = rnd.choice(file_ids)
+        start = time.perf_counter()
+        embedchain_util.query_doc([file_id], vector_question(rnd))
+        single.append(time.perf_counter() - start)
+
+        file_id_list = rnd.sample(file_ids, min(3, len(file_ids)))
+        start = time.perf_counter()
+        embedchain_util.query_doc(file_id_list, vector_question(rnd))
+        multi.append(time.perf_counter() - start)
+    return {'single_doc': distribution(single), 'three_docs': distribution(multi)}
+
+
+def bench_page_store(embedchain_util, rnd, file_ids, reads):
+    from PageStore import PageStore
+    page_store = embedchain_util.g_page_store
+    keys = {file_id: page_store.page_keys(file_id) for file_id in file_ids}
+    warm = []
+    for _ in range(reads):
+        file_id = rnd.choice(file_ids)
+        key = rnd.choice(keys[file_id])
+        start = time.perf_counter()
+        page_store.load_page(file_id, key)
+        warm.append(time.perf_counter() - start)
+
+    # 新的 PageStore 实例, 每个文档第一次读取需要加载 offset 索引
+    cold_store = PageStore(embedchain_util.config.STATIC_DIR, compress=page_store.compress)
+    cold = []
+    for file_id in file_ids:
+        start = time.perf_counter()
+        cold_store.load_page(file_id, keys[file_id][0])
+        cold.append(time.perf_counter() - start)
+    return {'warm_read': distribution(warm), 'first_read': distribution(cold)}
+
+
+async def bench_askdoc(web, question_router, rnd, file_ids, pages_per_doc, questions):
+    results = {}
+    route_before = dict(question_router.route_stats)
+    for name, make_question in [('vector', vector_question), ('pages', lambda r: page_question(r, pages_per_doc))]:
+        ttfb = []
+        total = []
+        for _ in range(questions):
+            payload = {'file_id_list': [rnd.choice(file_ids)], 'query': make_question(rnd), 'user': 'bench'}
+            first, whole, _ = await asgi_post(web.app, '/api7/askdoc', payload)
+            ttfb.append(first)
+            total.append(whole)
+        results[name] = {'ttfb': distribution(ttfb), 'total': distribution(total)}
+
+    # 同一个问题再问一次, 走答案缓存
+    payload = {'file_id_list': [file_ids[0]], 'query': vector_question(rnd), 'user': 'bench'}
+    await asgi_post(web.app, '/api7/askdoc', payload)
+    ttfb = []
+    for _ in range(questions):
+        first, _, _ = await asgi_post(web.app, '/api7/askdoc', payload)
+        ttfb.append(first)
+    results['answer_cache_hit'] = {'ttfb': distribution(ttfb)}
+    results['route_paths'] = {path: cnt - route_before.get(path, 0) for path, cnt in question_router.route_stats.items()}
+    return results
+
+
+async def run(args):
+    work_dir = tempfile.mkdtemp(prefix='chatbot-bench-')
+    os.chdir(work_dir)
+    sys.path.insert(0, BACKEND_DIR)
+    runner, proxy_host_port = await start_fake_llm(args.llm_ttfb_ms)
+    _install_config(work_dir, proxy_host_port, args.dimension)
+
+    web = importlib.import_module('web')
+    embedchain_util = importlib.import_module('embedchain_util')
+    question_router = importlib.import_module('question_router')
+    openai_proxy = importlib.import_module('openai_proxy')
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+
+    rnd = random.Random(args.seed)
+    sizes = sorted(int(s) for s in args.sizes.split(','))
+    doc_cnt = -(-sizes[-1] // args.pages_per_doc)
+    corpus = [synthetic_doc(rnd, args.pages_per_doc) for _ in range(doc_cnt)]
+
+    results = {'splitter': bench_splitter(embedchain_util, corpus[:max(1, doc_cnt // 4)])}
+
+    embed_seconds = 0.0
+    embedded_pages = 0
+    file_ids = []
+    query_results = []
+    for size in sizes:
+        while embedded_pages < size:
+            file_id = str(1000000 + len(file_ids))
+            start = time.perf_counter()
+            embedchain_util.embed_doc(file_id, corpus[len(file_ids)])
+            embed_seconds += time.perf_counter() - start
+            embedded_pages += args.pages_per_doc
+            file_ids.append(file_id)
+        query_results.append(dict(pages=embedded_pages, docs=len(file_ids),
+                                  **bench_query_doc(embedchain_util, rnd, file_ids, args.queries)))
+    results['embed_doc'] = {
+        'pages': embedded_pages,
+        'seconds': round(embed_seconds, 3),
+        'pages_per_s': round(embedded_pages / embed_seconds, 2),
+    }
+    results['query_doc'] = query_results
+    results['page_store'] = bench_page_store(embedchain_util, rnd, file_ids, args.reads)
+
+    await openai_proxy.startup()
+    try:
+        results['askdoc'] = await bench_askdoc(web, question_router, rnd, file_ids, args.pages_per_doc, args.questions)
+    finally:
+        await openai_proxy.shutdown()
+        await runner.cleanup()
+
+    return {
+        'meta': {
+            'revision': _git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            'work_dir': work_dir,
+        },
+        'results': results,
+    }
+
+
+def _flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            yield from _flatten(v, f'{prefix}.{k}' if prefix else str(k))
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            yield from _flatten(v, f'{prefix}[{i}]')
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(base, current):
+    base_metrics = dict(_flatten(base['results']))
+    for key, value in _flatten(current['results']):
+        if key in base_metrics and base_metrics[key]:
+            print(f'{key}: {base_metrics[key]} -> {value} ({value / base_metrics[key]:.2f}x)', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='20,100,400', help='corpus sizes in pages, query_doc is measured at each size')
+    parser.add_argument('--pages-per-doc', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=50, help='query_doc calls per corpus size')
+    parser.add_argument('--reads', type=int, default=2000, help='random page store reads')
+    parser.add_argument('--questions', type=int, default=20, help='/api7/askdoc requests per question type')
+    parser.add_argument('--dimension', type=int, default=512, help='hashing embedding dimension')
+    parser.add_argument('--llm-ttfb-ms', type=float, default=0, help='first byte delay of the fake LLM')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('-o', '--output', help='write the json result to this file instead of stdout')
+    parser.add_argument('--compare', help='earlier json result to compare with')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    base = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            base = json.load(f)
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if base:
+        compare(base, result)
+
+
+if __name__ == '__main__':
+    main()
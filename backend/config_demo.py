@@ -1,4 +1,54 @@
 PROXY_HOST_PORT = 'http://x.x.x.x:xx'
 UPLOAD_HOST_PORT = 'http://x.x.x.x:xx'
 API_KEY = 'xxx'
-APP_NAME = 'xxx'
\ No newline at end of file
+APP_NAME = 'xxx'
+# 可选: 文档级批量 embedding, 每批文本数 / 同时在途的请求数
+EMBED_BATCH_SIZE = 500
+EMBED_MAX_WORKERS = 4
+# 可选: 页面打包存储时按页 zstd 压缩 (需要 pip install zstandard)
+PAGE_STORE_COMPRESS = False
+# 可选: 多个 uvicorn worker 时用 redis 共享上传任务状态 (需要 pip install redis)
+# STATUS_REDIS_URL = 'redis://localhost:6379/0'
+# 可选: 入库任务队列, 解析/embedding 各阶段的并发数和最大重试次数; 解析时边解析边 embedding 也占用 INGEST_EMBED_WORKERS 的名额
+INGEST_PARSE_WORKERS = 2
+INGEST_EMBED_WORKERS = 1
+INGEST_MAX_ATTEMPTS = 3
+# 可选: 到 PROXY_HOST_PORT 的连接池
+PROXY_POOL_LIMIT = 100
+PROXY_KEEPALIVE_SECONDS = 60
+PROXY_CONNECT_TIMEOUT = 10
+PROXY_READ_TIMEOUT = 300
+# 可选: 答案缓存条数 / 过期秒数
+ANSWER_CACHE_SIZE = 1000
+ANSWER_CACHE_TTL = 86400
+# 可选: 语义近似问题缓存, 余弦相似度阈值 / 文档组合数上限 / 每组问题数上限 / 是否复用答案
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_SETS = 1000
+SEMANTIC_CACHE_MAX_ENTRIES = 256
+SEMANTIC_CACHE_REUSE_ANSWER = False
+# 可选: 入库后生成摘要树, 全文总结类问题直接用全文摘要回答
+SUMMARY_STAGE_ENABLED = False
+INGEST_SUMMARY_WORKERS = 1
+SUMMARY_MODEL = 'gpt-3.5-turbo'
+SUMMARY_CONCURRENCY = 4
+# 可选: 检索方式 vector / lexical (本地 BM25, 不请求 embedding) / hybrid (两者融合)
+RETRIEVAL_MODE = 'vector'
+# 可选: embedding backend, openai / hashing (离线, 无需模型) / sentence_transformers (离线, 需要 pip install sentence-transformers)
+EMBEDDING_BACKEND = 'openai'
+# 例如 {'model_name': 'text-embedding-ada-002'} / {'dimension': 512} / {'model_name': 'paraphrase-multilingual-MiniLM-L12-v2'}
+EMBEDDING_BACKEND_OPTIONS = {}
+# 可选: 并发问题的 query embedding 合并窗口(毫秒) / 每批最多条数
+QUERY_EMBED_WINDOW_MS = 5
+QUERY_EMBED_MAX_BATCH = 64
+# 可选: 每个文档单独一个 chroma collection, 多文档查询并行扇出, 删除文档即删除 collection
+VECTOR_SHARD_BY_DOCUMENT = False
+# 可选: 音频按时间分段并行转写 (需要安装 ffmpeg), 每段秒数 / 并发数 / 每段最多尝试次数 / 转写接口 (可换成本地服务)
+AUDIO_SEGMENT_SECONDS = 300
+AUDIO_TRANSCRIBE_CONCURRENCY = 4
+AUDIO_TRANSCRIBE_MAX_ATTEMPTS = 3
+# AUDIO_TRANSCRIBE_URL = 'http://localhost:5009/v1/audio/transcriptions'
+# 可选: 每个模型留给检索内容的 token 数 (安装 tiktoken 时按模型的 tokenizer 计数, 否则估计)
+CONTEXT_TOKEN_BUDGET = {'gpt-4': 3000, 'gpt-3.5-turbo': 2500}
+# 可选: 检索的 chunk 数 / 每个 chunk 前后各带多少字给到 gpt
+CONTEXT_N_RESULTS = 4
+CONTEXT_WINDOW_CHARS = 300
@@ -0,0 +1,148 @@
+import re
+import logging
+from functools import lru_cache
+from typing import List, Optional
+
+import config
+import metrics
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 每个模型留给检索内容的 token 数, 其余留给问题、指令和回答
+DEFAULT_BUDGETS = {
+    'gpt-4': 3000,
+    'gpt-3.5-turbo': 2500,
+}
+DEFAULT_BUDGET = 2500
+CONTEXT_TOKEN_BUDGET = {**DEFAULT_BUDGETS, **getattr(config, 'CONTEXT_TOKEN_BUDGET', {})}
+
+# 两段内容的字符 3-gram 有这么多落在已选内容里, 就当作重复丢掉
+DUPLICATE_CONTAINMENT = 0.8
+# 剩余预算不够这么多 token 时, 不再截一小段放进去
+MIN_PASSAGE_TOKENS = 50
+
+context_tokens = metrics.counter('chatbot_context_tokens_total', 'Context tokens before (input) and after (packed) packing')
+
+cjk_pattern = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+_space_pattern = re.compile(r'\s+')
+
+
+def estimate_tokens(text):
+    # 粗略估计: 中文约 1 字 1 token, 其余约 4 字符 1 token
+    cjk_cnt = len(cjk_pattern.findall(text))
+    return cjk_cnt + (len(text) - cjk_cnt + 3) // 4
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: str, model: str) -> int:
+    # 安装了 tiktoken 时按模型的 tokenizer 计数, 否则估计
+    if tiktoken is None:
+        return estimate_tokens(text)
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+def context_budget(model: str) -> int:
+    return CONTEXT_TOKEN_BUDGET.get(model, DEFAULT_BUDGET)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    if max_tokens <= 0:
+        return ''
+    # 一个 token 很少超过 8 个字符, 先按字符截断, 避免整本书都过一遍 tokenizer
+    text = text[:max_tokens * 8]
+    if tiktoken is not None:
+        tokens = _encoding(model).encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return _encoding(model).decode(tokens[:max_tokens])
+    cost = 0.0
+    for i, ch in enumerate(text):
+        cost += 1 if cjk_pattern.match(ch) else 0.25
+        if cost > max_tokens:
+            return text[:i]
+    return text
+
+
+def _shingles(text: str) -> set:
+    text = _space_pattern.sub('', text.lower())
+    return {text[i : i + 3] for i in range(max(1, len(text) - 2))}
+
+
+def drop_near_duplicates(passages: List[str]) -> List[str]:
+    """Keep passages in order, dropping any whose 3-grams mostly appear in a passage already kept."""
+    kept = []
+    kept_shingles = []
+    for passage in passages:
+        shingles = _shingles(passage)
+        if any(len(shingles & other) >= DUPLICATE_CONTAINMENT * len(shingles) for other in kept_shingles):
+            continue
+        kept.append(passage)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def _fair_shares(counts: List[int], budget: int) -> List[int]:
+    # 平均分配预算, 用不完的部分留给更长的内容
+    shares = [0] * len(counts)
+    remaining = budget
+    order = sorted(range(len(counts)), key=lambda i: counts[i])
+    for k, i in enumerate(order):
+        shares[i] = min(counts[i], remaining // (len(order) - k))
+        remaining -= shares[i]
+    return shares
+
+
+def pack(passages: List[str], model: str, reserved_tokens: int = 0, budget: Optional[int] = None,
+         even: bool = False) -> List[str]:
+    """Fit passages into the model's context budget.
+
+    Near-duplicates are dropped. Ranked passages (the default) are taken in order, the first
+    one that does not fit is cut to the remaining budget and the rest are dropped; with
+    even=True, e.g. pages the user asked for by number, every passage keeps a fair share.
+    """
+    budget = (budget if budget is not None else context_budget(model)) - reserved_tokens
+    unique = drop_near_duplicates(passages)
+    counts = [count_tokens(passage, model) for passage in passages]
+    tokens_in = sum(counts)
+    count_by_passage = dict(zip(passages, counts))
+    unique_counts = [count_by_passage[passage] for passage in unique]
+
+    if even:
+        shares = _fair_shares(unique_counts, budget)
+    else:
+        shares = []
+        remaining = budget
+        for tokens in unique_counts:
+            shares.append(min(tokens, remaining) if remaining >= MIN_PASSAGE_TOKENS or not shares else 0)
+            remaining -= shares[-1]
+
+    packed = []
+    used = 0
+    truncated = []
+    dropped = []
+    for i, (passage, tokens, share) in enumerate(zip(unique, unique_counts, shares)):
+        if share <= 0:
+            dropped.append(i)
+            continue
+        if share < tokens:
+            passage = truncate_to_tokens(passage, share, model)
+            truncated.append(i)
+        packed.append(passage)
+        used += share
+
+    context_tokens.inc(tokens_in, stage='input')
+    context_tokens.inc(used, stage='packed')
+    logging.info(f'context packed, model={model}, budget={budget}, passages={len(passages)}->{len(packed)}, '
+                 f'duplicates={len(passages) - len(unique)}, truncated={truncated}, dropped={dropped}, '
+                 f'tokens={tokens_in}->{used}, saved={tokens_in - used}')
+    return packed
@@ -3,13 +3,17 @@ import json
 import config
 import requests
 import logging
-from typing import Iterator
+from typing import Iterator, List, Tuple
 import sseclient
 from urllib.parse import urlencode
 
 
 os.environ["OPENAI_API_KEY"] = f"sk-{config.API_KEY}" # for audio
 
+import audio_transcribe
+
+PAGE_MARKER = '<|startofpage|>'
+
 
 def read_txt_file(file_path):
     with open(file_path, 'r') as file:
@@ -18,18 +22,8 @@ def read_txt_file(file_path):
 
 
 def _audio_to_script(local_file_path):
-    headers = {
-        'Authorization': f'Bearer {os.environ["OPENAI_API_KEY"]}',
-    }
-    data = {
-        'model': 'whisper-1',
-    }
-    files = {
-        'file': open(local_file_path, 'rb'),
-    }
-    response = requests.post('https://api.openai.com/v1/audio/transcriptions', headers=headers, data=data, files=files)
-    dict1 = response.json()
-    return dict1['text']
+    # 分段并行转写, 每段是一个带时间范围的页面
+    return ''.join(PAGE_MARKER + page for _, _, page in audio_transcribe.transcribe_pages(local_file_path))
 
 
 def _img_or_doc_to_txt(local_file_path):
@@ -45,6 +39,42 @@ def _img_or_doc_to_txt(local_file_path):
     return text_file_contents
 
 
+class TxtPageTail:
+    """Reads the pages the parse service has finished writing to a growing txt file.
+
+    A page is complete once the next <|startofpage|> marker is written (or the parse
+    is over). Pages come back as (page_index, text), numbered like
+    `txt_content.split('<|startofpage|>')`. Text without any marker is unpaginated
+    and is left to the regular embed stage.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.page_index = 0
+        self._offset = 0
+        self._buffer = b''
+        self._marker = PAGE_MARKER.encode('utf-8')
+
+    def read(self, final=False) -> List[Tuple[int, str]]:
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            self._offset += len(data)
+            self._buffer += data
+
+        # 按字节切分, 写到一半的多字节字符留在最后一段里
+        parts = self._buffer.split(self._marker)
+        if final and self.page_index == 0 and len(parts) == 1:
+            return []
+        self._buffer = b'' if final else parts.pop()
+        pages = []
+        for part in parts:
+            pages.append((self.page_index, part.decode('utf-8')))
+            self.page_index += 1
+        return pages
+
+
 def pdf_to_txt_stream(local_file_path) -> Iterator[str]:
     params = {
         'local_file': local_file_path,
@@ -60,9 +90,7 @@ def notpdf_to_txt_content(file_ext, local_file):
     if file_ext == '.txt':
         return read_txt_file(local_file)
     
-    audio_list = ['.mp3','.mp4','.m4a','.wav']
-    for audio in audio_list:
-        if local_file.endswith(audio):
-            return _audio_to_script(local_file)
+    if audio_transcribe.is_audio(local_file):
+        return _audio_to_script(local_file)
 
     return _img_or_doc_to_txt(local_file)
@@ -1,18 +1,66 @@
 import os
+import asyncio
 import logging
-import uuid
+import hashlib
+from collections import Counter
 from typing import List
 
 from langchain.docstore.document import Document
 from ChineseRecursiveTextSplitter import ChineseRecursiveTextSplitter
 from ChromaDB import ChromaDB
+from embedding_backends import create_embedding_backend
+from PageStore import PageStore
+from SemanticCache import SemanticCache
+from LexicalIndex import LexicalIndex
+from EmbeddingBatcher import EmbeddingBatcher
 import ChromaEmbed
+import context_packer
+from context_packer import estimate_tokens
+import metrics
 
 import config
 
 os.environ["OPENAI_API_KEY"] = f"sk-{config.API_KEY}"
 
-g_db = ChromaDB(config.APP_NAME + "_db", config.APP_NAME + "_db")
+g_embedding_backend = create_embedding_backend(getattr(config, 'EMBEDDING_BACKEND', 'openai'),
+                                               **getattr(config, 'EMBEDDING_BACKEND_OPTIONS', {}))
+g_db = ChromaDB(config.APP_NAME + "_db", config.APP_NAME + "_db", g_embedding_backend,
+               shard_by_document=getattr(config, 'VECTOR_SHARD_BY_DOCUMENT', False))
+
+g_page_store = PageStore(config.STATIC_DIR, compress=getattr(config, 'PAGE_STORE_COMPRESS', False))
+
+EMBED_BATCH_SIZE = getattr(config, 'EMBED_BATCH_SIZE', 500)
+EMBED_MAX_WORKERS = getattr(config, 'EMBED_MAX_WORKERS', 4)
+EMBED_PROGRESS_PAGES = 100
+
+g_semantic_cache = SemanticCache(
+    threshold=getattr(config, 'SEMANTIC_CACHE_THRESHOLD', 0.95),
+    max_sets=getattr(config, 'SEMANTIC_CACHE_MAX_SETS', 1000),
+    max_entries_per_set=getattr(config, 'SEMANTIC_CACHE_MAX_ENTRIES', 256),
+)
+# 命中语义缓存时是否连答案也复用
+SEMANTIC_CACHE_REUSE_ANSWER = getattr(config, 'SEMANTIC_CACHE_REUSE_ANSWER', False)
+
+# 本地 BM25 索引, 和页面一起按文档存放
+g_lexical_index = LexicalIndex(config.STATIC_DIR)
+
+# vector: 只用向量检索; lexical: 只用本地词法索引, 不请求 embedding; hybrid: 两者按排名融合
+RETRIEVAL_MODE = getattr(config, 'RETRIEVAL_MODE', 'vector')
+# 检索的 chunk 数, 每个 chunk 只取它前后各 CONTEXT_WINDOW_CHARS 字给到 gpt, 不再发送整页
+QUERY_N_RESULTS = getattr(config, 'CONTEXT_N_RESULTS', 4)
+CONTEXT_WINDOW_CHARS = getattr(config, 'CONTEXT_WINDOW_CHARS', 300)
+
+g_query_batcher = EmbeddingBatcher(g_db.embedding_fn,
+                                   window_ms=getattr(config, 'QUERY_EMBED_WINDOW_MS', 5),
+                                   max_batch=getattr(config, 'QUERY_EMBED_MAX_BATCH', 64))
+
+pages_embedded = metrics.counter('chatbot_pages_embedded_total', 'Pages split, embedded and stored')
+metrics.collect('chatbot_embedding_cache_total', 'Embedding cache lookups by result',
+                lambda: {(('result', 'hit'),): g_db.embedding_fn.hits, (('result', 'miss'),): g_db.embedding_fn.misses},
+                type='counter')
+metrics.collect('chatbot_semantic_cache_total', 'Semantic cache lookups by result',
+                lambda: {(('result', 'hit'),): g_semantic_cache.hits, (('result', 'miss'),): g_semantic_cache.misses},
+                type='counter')
 
 
 import re
@@ -31,131 +79,405 @@ def is_index_page(page_text, number_threshold=0.35, http_cnt_threshold=5):
         return True
     return False
 
-def _save_page(file_id, page_index, page_text):
-    os.makedirs(config.STATIC_DIR, exist_ok=True)
-    os.makedirs(os.path.join(config.STATIC_DIR, file_id), exist_ok=True)
-    with open(os.path.join(config.STATIC_DIR, file_id, str(page_index) + '.txt'), 'w') as f:
-        f.write(page_text)
 
+def _page_attrs(page_text, page_number=-1):
+    return {
+        'fingerprint': hashlib.sha1(page_text.encode('utf-8')).hexdigest(),
+        'is_index_page': is_index_page(page_text),
+        'page_number': page_number,
+        'chars': len(page_text),
+        'tokens': estimate_tokens(page_text),
+    }
 
-def _load_page(file_id, page_index):
-    f1 = os.path.join(config.STATIC_DIR, file_id, str(page_index) + '.txt')
-    if os.path.exists(f1):
-        with open(f1, 'r') as f:
-            return f.read()
-    else:
-        logging.info(f'page not exist, file={f1}')
-    return None
 
+def _save_page(file_id, page_index, page_text, attrs=None):
+    g_page_store.save_page(file_id, str(page_index), page_text, attrs)
 
-def _embed_one_page(file_id, text_page, page_index_key):
-    text_splitter = ChineseRecursiveTextSplitter(
-        chunk_size=150,
-        chunk_overlap=0,
-        length_function=len,
-    )
 
-    _1,_2,_3,_4 = ChromaEmbed.load_and_embed(g_db, text_splitter, text_page, file_id,
-        {'file_id': file_id, 'page_index': page_index_key})
-    
-    for i,doc in enumerate(_1):
-        logging.info(f'page_key={page_index_key}, doc=[{i}/{len(_1)}], doc.chars={len(doc)}, doc.content={doc}')
-    logging.info(f'end page_key={page_index_key}, app.db.cnt={g_db.count()}')
+def _load_page(file_id, page_index):
+    page_text = g_page_store.load_page(file_id, str(page_index))
+    if page_text is None:
+        logging.info(f'page not exist, file_id={file_id}, page_index={page_index}')
+    return page_text
+
+
+# splitter 没有状态, 全局共用, 不再每页新建
+g_chunk_splitter = ChineseRecursiveTextSplitter(
+    chunk_size=150,
+    chunk_overlap=0,
+    length_function=len,
+)
+g_page_splitter = ChineseRecursiveTextSplitter(chunk_size=1000)
+
+
+def _embed_pages(file_id, page_list, on_pages_done=None):
+    # 整篇文档一起切分、去重、批量 embedding, 避免每页都查询/写入一次 db
+    # 每 EMBED_PROGRESS_PAGES 页回调一次进度, 中断后可以从这里继续
+    for start in range(0, len(page_list), EMBED_PROGRESS_PAGES):
+        group = page_list[start : start + EMBED_PROGRESS_PAGES]
+        pages = [(text_page, {'file_id': file_id, 'page_index': page_index_key,
+                              'page_number': attrs['page_number'], 'is_index_page': attrs['is_index_page']})
+                 for page_index_key, text_page, attrs in group]
+        _1,_2,_3,_4 = ChromaEmbed.load_and_embed_pages(g_db, g_chunk_splitter, pages, file_id,
+            batch_size=EMBED_BATCH_SIZE, max_workers=EMBED_MAX_WORKERS,
+            on_chunks=lambda docs, metas, ids: g_lexical_index.add(
+                file_id, [(id, meta['page_index'], doc, meta['chunk_start'], meta['chunk_end'])
+                          for doc, meta, id in zip(docs, metas, ids)]))
+        # 向量写入后再保存页面, 页面存在即表示已经 embedding 过
+        for page_index_key, text_page, attrs in group:
+            _save_page(file_id, page_index_key, text_page, attrs)
+        pages_embedded.inc(len(group))
+        logging.info(f'end embed file_id={file_id}, pages={start + len(group)}/{len(page_list)}, new chunks={_4}')
+        if on_pages_done:
+            on_pages_done([page_index_key for page_index_key, _, _ in group], start + len(group), len(page_list))
+
+
+def _page_entry(page_index, text_page):
+    """(page_key, page_text, page_number) of the page_index-th <|startofpage|> page, None for empty pages."""
+    if text_page.strip() == '':
+        logging.info(f'ignore empty page, page_index={page_index}')
+        return None
+
+    page_number = -1
+    try:
+        page_number = int(text_page[1:text_page.find('页')])
+    except:
+        pass
+    if page_number == -1:
+        page_index_key = 'page_index_' + str(page_index)
+    else:
+        page_index_key = 'page_number_' + str(page_number)
+    return page_index_key, text_page, page_number
 
 
-def embed_doc(file_id, txt_content):
+def split_pages(txt_content):
+    """Return [(page_key, page_text, page_number)], page keys only depend on the text."""
     text_pages = txt_content.split('<|startofpage|>')
 
     if len(text_pages) == 1: 
-        # 未分页的文章, 按大段分页
-        parent_splitter = ChineseRecursiveTextSplitter(chunk_size=1000)
-        documents = parent_splitter.split_text(txt_content)
+        # 未分页的文章, 按大段分页, key 用段落序号, 重复入库时保持不变
+        documents = g_page_splitter.split_text(txt_content)
         logging.info(f'file is split to size={len(documents)}')
-        for _i, _doc in enumerate(documents):
-            page_index_key = f'{_i}_{str(uuid.uuid4())}'
-            _save_page(file_id, page_index_key, _doc)
-            _embed_one_page(file_id, _doc, page_index_key)
-        return
+        return [(f'part_{_i}', _doc, -1) for _i, _doc in enumerate(documents)]
+
+    entries = (_page_entry(page_index, text_page) for page_index, text_page in enumerate(text_pages))
+    return [entry for entry in entries if entry]
 
-    page_index = 0
-    for text_page in text_pages:
-        logging.info(f'process page_index = {page_index}')
-        page_index_copy = page_index
-        page_index += 1
 
-        if text_page.strip() == '':
-            logging.info(f'ignore empty page, page_index={page_index_copy}')
+def _sync_pages(file_id, pages, completed_pages, on_pages_done, remove_missing):
+    old_keys = set(g_page_store.page_keys(file_id))
+    stats = Counter()
+    page_list = []
+    new_keys = set()
+    changed_keys = []
+    for page_index_key, text_page, page_number in pages:
+        new_keys.add(page_index_key)
+        if page_index_key in completed_pages:
+            stats['unchanged'] += 1
             continue
 
-        page_number = -1
-        try:
-            page_number = int(text_page[1:text_page.find('页')])
-        except:
-            pass
-        if page_number == -1:
-            page_index_key = 'page_index_' + str(page_index_copy)
+        attrs = _page_attrs(text_page, page_number)
+        if page_index_key in old_keys:
+            old_attrs = g_page_store.page_attrs(file_id, page_index_key) or {}
+            if old_attrs.get('fingerprint') == attrs['fingerprint']:
+                stats['unchanged'] += 1
+                continue
+            stats['changed'] += 1
+            changed_keys.append(page_index_key)
         else:
-            page_index_key = 'page_number_' + str(page_number)
+            stats['added'] += 1
 
-        _save_page(file_id, page_index_key, text_page)
-        if (is_index_page(text_page)):
-            logging.warn(f'忽略索引! page_index={page_index_copy}, page_number={page_number}')
+        if attrs['is_index_page']:
+            logging.warn(f'忽略索引! page_key={page_index_key}, page_number={page_number}')
+            _save_page(file_id, page_index_key, text_page, attrs)
             continue
-        _embed_one_page(file_id, text_page, page_index_key)
+        page_list.append((page_index_key, text_page, attrs))
+
+    removed_keys = [key for key in old_keys if key not in new_keys] if remove_missing else []
+    stats['removed'] = len(removed_keys)
+    stale_keys = changed_keys + removed_keys
+    if stale_keys:
+        # 先删页面再删向量, 中途中断时这些页面会被当作新页面重新 embedding
+        g_page_store.delete_pages(file_id, stale_keys)
+        g_db.delete_pages(file_id, stale_keys)
+        g_lexical_index.remove_pages(file_id, stale_keys)
+
+    _embed_pages(file_id, page_list, on_pages_done)
+    if stale_keys:
+        g_page_store.compact(file_id)
+    return dict(stats)
+
+
+def embed_doc(file_id, txt_content, completed_pages=None, on_pages_done=None):
+    """completed_pages: page keys already embedded by an interrupted run, they are skipped.
+    on_pages_done(page_keys, done_cnt, total_cnt) is called as pages are embedded.
+
+    Re-ingesting a document diffs page fingerprints: only new or changed pages are
+    embedded, chunks of changed or vanished pages are deleted. Returns page counts.
+    """
+    stats = _sync_pages(file_id, split_pages(txt_content), completed_pages or set(), on_pages_done, remove_missing=True)
+    logging.info(f'embed doc done, file_id={file_id}, pages={stats}')
+    return stats
+
+
+def embed_stream_pages(file_id, indexed_pages):
+    """Embed [(page_index, page_text)] of a paginated document that is still being parsed.
+
+    Each page is queryable once this returns; pages that vanished are only removed by
+    the embed_doc run after parsing, which skips the pages embedded here.
+    """
+    pages = [entry for entry in (_page_entry(i, text_page) for i, text_page in indexed_pages) if entry]
+    stats = _sync_pages(file_id, pages, set(), None, remove_missing=False)
+    logging.info(f'embed stream pages done, file_id={file_id}, pages={stats}')
+    return stats
+
+
+def delete_doc(file_id):
+    # 删除文档的向量、词法索引和页面
+    g_db.delete_doc(file_id)
+    g_lexical_index.drop(file_id)
+    g_page_store.drop(file_id)
+    logging.info(f'doc deleted, file_id={file_id}')
 
 
-def query_doc(file_id_list, query_str):
+def doc_version(file_id_list):
+    # 页面存储的索引文件在任何进程写入、删除后都会变化, 各进程的缓存都用它区分文档版本
+    return tuple(g_page_store.version(file_id) for file_id in sorted(file_id_list))
 
-    if (len(file_id_list) == 1):
-        where = {"file_id": file_id_list[0]}
+
+def _vector_docs(file_id_list, query_str, query_embedding, n_results):
+    logging.info(f'query db, file_id_list={file_id_list}, query_str={query_str}')
+    doc_and_dist_list = g_db.query_docs(file_id_list, query_str, n_results, query_embedding)
+    for i, doc_and_dist in enumerate(doc_and_dist_list):
+        logging.info(f'query db result, i={i + 1} doc_and_dist={doc_and_dist}')
+    return [doc for doc, _ in doc_and_dist_list]
+
+
+def _backfill_lexical(file_id):
+    # 词法索引上线前入库的文档没有 .lex, 第一次用到时从已保存的页面重建一次
+    if g_lexical_index.has_doc(file_id) or not g_page_store.has_doc(file_id):
+        return
+    chunks = []
+    for page_index_key in g_page_store.page_keys(file_id):
+        attrs = g_page_store.page_attrs(file_id, page_index_key) or {}
+        page_text = _load_page(file_id, page_index_key)
+        if not page_text or attrs.get('is_index_page'):
+            continue
+        metadata = {'file_id': file_id, 'page_index': page_index_key,
+                    'page_number': attrs.get('page_number', -1), 'is_index_page': False}
+        for chunk, start, end in g_chunk_splitter.split_text_with_offsets(page_text):
+            chunks.append((_chunk_id(chunk, metadata), page_index_key, chunk, start, end))
+    # 没有任何 chunk 时也会留下空的索引文件, 不会每次查询都重建
+    added = g_lexical_index.add(file_id, chunks)
+    logging.info(f'lexical index rebuilt from pages, file_id={file_id}, chunks={added}')
+
+
+def _chunk_id(chunk, metadata):
+    # 和 ChromaEmbed._create_chunks 的 id 一致
+    return hashlib.sha256((chunk + str(metadata)).encode()).hexdigest()
+
+
+def _find_chunk(page_text, metadata):
+    # 早期的词法索引只记录了 chunk id, 重新切分页面找到同一个 chunk, 找不到返回 (None, None)
+    page_index = metadata['page_index']
+    page_number = int(page_index[len('page_number_'):]) if page_index.startswith('page_number_') else -1
+    chunk_metadata = {'file_id': metadata['file_id'], 'page_index': page_index,
+                      'page_number': page_number, 'is_index_page': False}
+    for chunk, start, end in g_chunk_splitter.split_text_with_offsets(page_text):
+        if _chunk_id(chunk, chunk_metadata) == metadata['chunk_id']:
+            return start, end
+    return None, None
+
+
+def _lexical_docs(file_id_list, query_str, n_results):
+    for file_id in file_id_list:
+        _backfill_lexical(file_id)
+    results = g_lexical_index.search(file_id_list, query_str, n_results)
+    logging.info(f'lexical query result, query_str={query_str}, results={results}')
+    return [Document(page_content='', metadata={'file_id': file_id, 'page_index': page_index, 'chunk_id': chunk_id,
+                                                'chunk_start': start, 'chunk_end': end})
+            for file_id, page_index, chunk_id, _, (start, end) in results]
+
+
+def _fuse_docs(ranked_lists, n_results, k=60):
+    # Reciprocal Rank Fusion, 向量距离和 BM25 分数量纲不同, 按排名融合
+    scores = {}
+    docs = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked):
+            key = (doc.metadata['file_id'], doc.metadata['page_index'])
+            scores[key] = scores.get(key, 0) + 1 / (k + rank + 1)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:n_results]
+    return [docs[key] for key in best]
+
+
+sentence_end_pattern = re.compile(r'[。！？!?\n]|\.\s')
+
+
+def _chunk_span(page_text, doc):
+    # 命中的 chunk 在页面中的位置; 老数据没有记录偏移时在页面里查找, 找不到就用整页
+    start, end = doc.metadata.get('chunk_start'), doc.metadata.get('chunk_end')
+    if start is None and doc.page_content:
+        start = page_text.find(doc.page_content)
+        end = start + len(doc.page_content)
+    elif start is None and doc.metadata.get('chunk_id'):
+        start, end = _find_chunk(page_text, doc.metadata)
+    if start is None or start < 0 or end > len(page_text):
+        return 0, len(page_text)
+    return start, end
+
+
+def _window(page_text, start, end):
+    # 前后各扩展 CONTEXT_WINDOW_CHARS 字, 再往里收到句子边界, 不从半句话开始或结束
+    left = max(0, start - CONTEXT_WINDOW_CHARS)
+    right = min(len(page_text), end + CONTEXT_WINDOW_CHARS)
+    if left > 0:
+        m = sentence_end_pattern.search(page_text, left, start)
+        if m:
+            left = m.end()
+    if right < len(page_text):
+        ends = [m.end() for m in sentence_end_pattern.finditer(page_text, end, right)]
+        if ends:
+            right = ends[-1]
+    return left, right
+
+
+def _page_passages(page_text, spans):
+    """Windows around the matched chunks of one page, overlapping windows merged, in page order."""
+    windows = sorted(_window(page_text, start, end) for start, end in spans)
+    merged = [list(windows[0])]
+    for start, end in windows[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    # 页面第一行一般是页码或音频的时间段, 窗口不在页首时带上, 回答时可以引用
+    first_line = page_text.lstrip().split('\n', 1)[0]
+    heading = first_line + '\n' if len(first_line) <= 30 else ''
+    return [(heading if start > 0 else '') + page_text[start:end].strip() for start, end in merged]
+
+
+def query_doc(file_id_list, query_str, mode=None, query_embedding=None):
+    mode = mode or RETRIEVAL_MODE
+    if mode not in ('lexical', 'hybrid'):
+        mode = 'vector'
+
+    if mode == 'lexical':
+        query_embedding = None
     else:
-        cond_list = []
-        for file_id in file_id_list:
-            cond_list.append({"file_id": file_id})
-        where={"$or": cond_list}
-
-    logging.info(f'query db, where={where}, query_str={query_str}')
-    doc_and_dist_list = g_db.query(query_str, n_results=2, where=where)
-    if len(doc_and_dist_list) == 0:
+        if query_embedding is None:
+            with metrics.span('query_embedding'):
+                query_embedding = g_db.embedding_fn([query_str])[0]
+        # 意思相近的问题直接复用之前的检索结果
+        version = doc_version(file_id_list)
+        hit = g_semantic_cache.get(file_id_list, query_embedding, version)
+        if hit is not None:
+            logging.info(f'semantic cache hit, query={query_str}, earlier query={hit[0]}, '
+                         f'hits={g_semantic_cache.hits}, misses={g_semantic_cache.misses}')
+            return list(hit[1])
+
+    with metrics.span('search', mode=mode):
+        if mode == 'lexical':
+            doc_list = _lexical_docs(file_id_list, query_str, QUERY_N_RESULTS)
+        elif mode == 'hybrid':
+            doc_list = _fuse_docs([_vector_docs(file_id_list, query_str, query_embedding, QUERY_N_RESULTS * 2),
+                                   _lexical_docs(file_id_list, query_str, QUERY_N_RESULTS * 2)], QUERY_N_RESULTS)
+        else:
+            doc_list = _vector_docs(file_id_list, query_str, query_embedding, QUERY_N_RESULTS)
+    if len(doc_list) == 0:
         raise Exception('no_query_result')
     
-    # 根据查出来的 page_index 反过来找整页给到 gpt
-    context_list = []
-    page_list = []
-    i=0
-    for doc_and_dist in doc_and_dist_list:
-        i+=1
-        logging.info(f'query db result, i={i} doc_and_dist={doc_and_dist}')
-        doc = doc_and_dist[0]
-
+    # 根据查出来的 chunk 找到所在页面, 每页只读一次, 取命中位置附近的窗口给到 gpt
+    page_texts = {}
+    page_spans = {}
+    for doc in doc_list:
         page_index = doc.metadata['page_index']
         file_id = doc.metadata['file_id']
+        if (file_id, page_index) in page_texts:
+            if page_texts[(file_id, page_index)]:
+                page_spans[(file_id, page_index)].append(_chunk_span(page_texts[(file_id, page_index)], doc))
+            continue
+        page_texts[(file_id, page_index)] = None
+
+        with metrics.span('page_load'):
+            c1 = _load_page(file_id, page_index)
+        if not c1:
+            continue
 
-        if is_index_page(_load_page(file_id, page_index)):
+        # 入库时已算好的属性优先, 老数据才用正则重新判断
+        page_is_index = doc.metadata.get('is_index_page')
+        if page_is_index is None:
+            attrs = g_page_store.page_attrs(file_id, page_index)
+            page_is_index = attrs['is_index_page'] if attrs is not None else is_index_page(c1)
+        if page_is_index:
             logging.warn(f'检查出page_index={page_index}是整页索引，排除掉')
             continue
 
-        if (file_id, page_index) not in page_list:
-            page_list.append((file_id, page_index))
-    
-    logging.info(f'page_list={page_list}')
-    for (file_id, page_index) in page_list:
-        c1 = _load_page(file_id, page_index)
-        if c1:
-            context_list.append(c1)
+        page_texts[(file_id, page_index)] = c1
+        page_spans[(file_id, page_index)] = [_chunk_span(c1, doc)]
+
+    # 按页面第一次命中的顺序排列
+    context_list = []
+    for key, spans in page_spans.items():
+        context_list.extend(_page_passages(page_texts[key], spans))
+    logging.info(f'page_list={list(page_spans)}, passages={len(context_list)}, '
+                 f'chars={sum(len(c) for c in context_list)}, page chars={sum(len(page_texts[k]) for k in page_spans)}')
 
     if len(context_list) == 0:
         raise Exception('no_query_result')
     
+    if query_embedding is not None:
+        g_semantic_cache.put(file_id_list, query_embedding, query_str, context_list, version)
     return context_list
 
 
+async def aquery_doc(file_id_list, query_str, mode=None):
+    mode = mode or RETRIEVAL_MODE
+    query_embedding = None
+    if mode != 'lexical':
+        # 并发请求的 query 合并成一次 embedding 调用
+        with metrics.span('query_embedding'):
+            query_embedding = await g_query_batcher.embed(query_str)
+    # 查询和读取页面都在线程里执行, 不阻塞事件循环
+    return await asyncio.to_thread(query_doc, file_id_list, query_str, mode, query_embedding)
+
+
 from fastapi.responses import StreamingResponse
 import openai_proxy
 
+from AnswerCache import AnswerCache, answer_key
+from question_router import normalize_question
+
+g_answer_cache = AnswerCache(max_items=getattr(config, 'ANSWER_CACHE_SIZE', 1000), ttl=getattr(config, 'ANSWER_CACHE_TTL', 86400))
+metrics.collect('chatbot_answer_cache_total', 'Answer cache lookups by result',
+                lambda: {(('result', 'hit'),): g_answer_cache.hits, (('result', 'miss'),): g_answer_cache.misses},
+                type='counter')
+
+
+async def cached_answer(user_name, prompt, model, query_str, file_id_list, context) -> StreamingResponse:
+    # 相同问题 + 相同文件 + 相同检索内容, 直接回放之前的答案
+    if not file_id_list:
+        return await openai_proxy.proxy(user_name, prompt, model)
+    version = doc_version(file_id_list)
+    key = answer_key(normalize_question(query_str), file_id_list, context, str(version))
+    answer = g_answer_cache.get(key)
+    if answer is None and SEMANTIC_CACHE_REUSE_ANSWER:
+        # 换个说法的同一个问题, 用之前那个问题的答案
+        query_embedding = await g_query_batcher.embed(query_str)
+        hit = g_semantic_cache.get(file_id_list, query_embedding, version)
+        if hit is not None and hit[0] != query_str:
+            answer = g_answer_cache.get(answer_key(normalize_question(hit[0]), file_id_list, context, str(version)))
+    if answer is not None:
+        logging.info(f'answer cache hit, query={query_str}, hits={g_answer_cache.hits}, misses={g_answer_cache.misses}')
+        return openai_proxy.replay(answer)
+    return await openai_proxy.proxy(user_name, prompt, model,
+        on_complete=lambda text: g_answer_cache.put(key, text, file_id_list))
+
+
 async def ask_doc(user_name, file_id_list: List[str], query_str) -> StreamingResponse:
-    context_list = query_doc(file_id_list, query_str)
-    return await ask_doc_context(user_name, context_list, query_str)
+    context_list = await aquery_doc(file_id_list, query_str)
+    return await ask_doc_context(user_name, context_list, query_str, file_id_list)
 
 
 def get_context_list(file_id, page_number_list):
@@ -169,13 +491,19 @@ def get_context_list(file_id, page_number_list):
     return context_list
 
 
-async def ask_doc_context(user_name, context_list, query_str) -> StreamingResponse:
+async def ask_doc_context(user_name, context_list, query_str, file_id_list=None, even_budget=False) -> StreamingResponse:
+    # even_budget: 用户指定的页面, 每页平分 token 预算, 不按排名丢弃后面的页
 
-    prompt = f"""
+    with metrics.span('prompt_assembly'):
+        # 去掉重复的内容, 按模型的 token 预算裁剪, 问题本身也占预算
+        context_list = context_packer.pack(context_list, 'gpt-4', reserved_tokens=context_packer.count_tokens(query_str, 'gpt-4'),
+                                           even=even_budget)
+        context = ' | '.join(context_list)
+        prompt = f"""
   Use the following pieces of context to answer the query at the end.
   If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
-{' | '.join(context_list)}
+{context}
 
   Query: {query_str}
 
@@ -183,7 +511,7 @@ async def ask_doc_context(user_name, context_list, query_str) -> StreamingRespon
 """
     logging.info(f'prompt={prompt[:1000]}')
     #return prompt
-    return await openai_proxy.proxy(user_name, prompt, 'gpt-4')
+    return await cached_answer(user_name, prompt, 'gpt-4', query_str, file_id_list, context)
 
 
 
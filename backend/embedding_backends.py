@@ -0,0 +1,120 @@
+import os
+import zlib
+import hashlib
+import logging
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+from chromadb.utils import embedding_functions
+
+from LexicalIndex import tokenize
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+
+class OpenAIBackend:
+    name = 'openai'
+    default_model_name = "text-embedding-ada-002"
+
+    def __init__(self, model_name: str = default_model_name):
+        self.model_name = model_name
+        self._fn = embedding_functions.OpenAIEmbeddingFunction(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            organization_id=os.getenv("OPENAI_ORGANIZATION"),
+            model_name=model_name,
+        )
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return self._fn(input)
+
+
+class LocalBackend(ABC):
+    """Offline CPU backend: texts are embedded in numpy batches, batches run on a thread pool."""
+
+    name = 'local'
+
+    def __init__(self, batch_size: int = 64, max_workers: int = 4):
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'embed-{self.name}')
+
+    @abstractmethod
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Embed one batch, one row per text."""
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        batches = [input[i : i + self.batch_size] for i in range(0, len(input), self.batch_size)]
+        if len(batches) <= 1:
+            results = [self._embed_batch(batch) for batch in batches]
+        else:
+            results = list(self._executor.map(self._embed_batch, batches))
+        return [row.tolist() for matrix in results for row in matrix]
+
+
+class HashingBackend(LocalBackend):
+    """Signed feature hashing of Chinese bigrams / English words, l2 normalized. No model download needed."""
+
+    name = 'hashing'
+
+    def __init__(self, dimension: int = 512, **kwargs):
+        super().__init__(**kwargs)
+        self.dimension = dimension
+        self.model_name = f'hashing-{dimension}'
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            if not counts:
+                continue
+            # crc32 在不同进程间稳定, python 自带的 hash() 每个进程都不一样
+            hashes = np.array([zlib.crc32(term.encode()) for term in counts], dtype=np.int64)
+            weights = np.log1p(np.array(list(counts.values()), dtype=np.float32))
+            signs = np.where((hashes >> 16) & 1, 1.0, -1.0).astype(np.float32)
+            np.add.at(matrix[row], hashes % self.dimension, signs * weights)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+
+class SentenceTransformerBackend(LocalBackend):
+    name = 'sentence_transformers'
+
+    def __init__(self, model_name: str = 'paraphrase-multilingual-MiniLM-L12-v2', **kwargs):
+        if SentenceTransformer is None:
+            raise ImportError('sentence-transformers is required for this backend, pip install sentence-transformers')
+        super().__init__(**kwargs)
+        self.model_name = model_name
+        self._model = SentenceTransformer(model_name, device='cpu')
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        return self._model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True)
+
+
+BACKENDS = {
+    OpenAIBackend.name: OpenAIBackend,
+    HashingBackend.name: HashingBackend,
+    SentenceTransformerBackend.name: SentenceTransformerBackend,
+}
+
+
+def create_embedding_backend(name: str = 'openai', **options):
+    if name not in BACKENDS:
+        raise ValueError(f'unknown embedding backend: {name}, available: {list(BACKENDS)}')
+    backend = BACKENDS[name](**options)
+    logging.info(f'embedding backend={name}, model={backend.model_name}')
+    return backend
+
+
+def collection_suffix(backend) -> str:
+    # 每个 backend/模型单独一个 collection, 不同维度的向量不会混在一起; openai 沿用原来的 collection
+    if backend.name == OpenAIBackend.name and backend.model_name == OpenAIBackend.default_model_name:
+        return ''
+    # chroma 的 collection 名最长 63 个字符, 模型名用短 hash 表示
+    return f'_{backend.name}_{hashlib.md5(backend.model_name.encode()).hexdigest()[:8]}'
@@ -0,0 +1,146 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 秒, 覆盖本地毫秒级操作到上游几十秒的回答
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.type = 'counter'
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(k)} {v}' for k, v in self._values.items()]
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = 'histogram'
+        self.buckets = tuple(buckets)
+        # labels -> [每个桶的计数..., +Inf 桶, sum]
+        self._values: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        for key, counts in items:
+            cumulative = 0
+            for bound, cnt in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += cnt
+                lines.append(f'{self.name}_bucket{_format_labels(key, ("le", str(bound)))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+class Collected:
+    """Counter or gauge read from existing state when scraped, e.g. cache hit counters or queue depth.
+
+    fn() returns a number, or {labels dict as tuple of pairs: value}.
+    """
+
+    def __init__(self, name: str, help: str, type: str, fn: Callable):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.fn = fn
+
+    def samples(self) -> List[str]:
+        value = self.fn()
+        if not isinstance(value, dict):
+            return [f'{self.name} {value}']
+        return [f'{self.name}{_format_labels(_labels(dict(k)))} {v}' for k, v in value.items()]
+
+
+_registry: Dict[str, object] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def counter(name: str, help: str) -> Counter:
+    return _register(Counter(name, help))
+
+
+def histogram(name: str, help: str, buckets=LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, buckets))
+
+
+def collect(name: str, help: str, fn: Callable, type: str = 'gauge'):
+    # 同名的后注册的覆盖前面的, 模块重新加载时不会留下旧的回调
+    with _registry_lock:
+        _registry[name] = Collected(name, help, type, fn)
+
+
+span_seconds = histogram('chatbot_span_seconds', 'Time spent in each stage of the request / ingest hot paths')
+
+
+@contextmanager
+def span(name: str, **labels):
+    """Time a block into chatbot_span_seconds{span=name}; exceptions are recorded too."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_seconds.observe(time.perf_counter() - start, span=name, **labels)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            lines.append(f'# {metric.name} collect failed: {e}')
+            continue
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
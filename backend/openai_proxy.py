@@ -1,34 +1,157 @@
 import config
+import metrics
 URL = f'{config.PROXY_HOST_PORT}/openai-api-proxy/chat'
 
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
 import aiohttp
 import logging
+import time
+from collections import deque
+from typing import Optional
 
-async def proxy(user, prompt, model) -> StreamingResponse:
-    generator = proxy_generator(user, prompt, model)
+POOL_LIMIT = getattr(config, 'PROXY_POOL_LIMIT', 100)
+KEEPALIVE_SECONDS = getattr(config, 'PROXY_KEEPALIVE_SECONDS', 60)
+CONNECT_TIMEOUT = getattr(config, 'PROXY_CONNECT_TIMEOUT', 10)
+READ_TIMEOUT = getattr(config, 'PROXY_READ_TIMEOUT', 300)
+
+# 最近的上游请求耗时: connect / ttfb / total(秒), bytes, throughput(bytes/s)
+recent_calls = deque(maxlen=1000)
+
+_session: Optional[aiohttp.ClientSession] = None
+
+upstream_ttfb = metrics.histogram('chatbot_upstream_ttfb_seconds', 'Time to first byte of upstream LLM calls')
+upstream_seconds = metrics.histogram('chatbot_upstream_seconds', 'Total time of upstream LLM calls')
+upstream_errors = metrics.counter('chatbot_upstream_errors_total', 'Upstream LLM calls that raised')
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.trace_request_ctx['connect_start'] = time.perf_counter()
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.trace_request_ctx['connect'] = time.perf_counter() - ctx.trace_request_ctx['connect_start']
+
+    async def on_connection_reuseconn(session, ctx, params):
+        ctx.trace_request_ctx['reused'] = True
+
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+async def startup():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_LIMIT, keepalive_timeout=KEEPALIVE_SECONDS)
+        timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[_trace_config()])
+
+
+async def shutdown():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    # 正常由 app startup 创建, 单独运行脚本时按需创建
+    if _session is None or _session.closed:
+        await startup()
+    return _session
+
+
+def _new_stats(user, model):
+    return {'user': user, 'model': model, 'reused': False, 'connect': 0.0, 'start': time.perf_counter()}
+
+
+def _record_call(name, stats):
+    stats.pop('connect_start', None)
+    start = stats.pop('start')
+    stats['total'] = time.perf_counter() - start
+    recent_calls.append(dict(stats, name=name))
+    if 'ttfb' in stats:
+        upstream_ttfb.observe(stats['ttfb'], name=name, model=stats['model'])
+    upstream_seconds.observe(stats['total'], name=name, model=stats['model'])
+    if 'error' in stats:
+        upstream_errors.inc(name=name, model=stats['model'])
+    logging.info(f'upstream {name}, model={stats["model"]}, reused={stats["reused"]}, connect={stats["connect"]:.3f}s, '
+                 f'ttfb={stats.get("ttfb", -1):.3f}s, total={stats["total"]:.3f}s, '
+                 f'bytes={stats.get("bytes", 0)}, throughput={stats.get("throughput", 0):.0f}B/s')
+
+
+async def proxy(user, prompt, model, on_complete=None) -> StreamingResponse:
+    generator = proxy_generator(user, prompt, model, on_complete)
     return StreamingResponse(generator)
 
-async def proxy_generator(user: str, prompt: str, model: str):
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(URL, json={"prompt":prompt, "user": user, "user_group": "marvin", "model": model}) as response:
-                s = ''
-                async for data in response.content.iter_any():
-                    yield data
-                    try:
-                        s += str(data.decode('utf-8'))
-                    except:
-                        logging.exception('ops')
-                        
-                logging.info('========start reply========')
-                logging.info(s)
-                logging.info('========end of reply========')
-        except Exception as e:
-            yield f'Exception: {e}'
-
-async def proxy_sync(user: str, prompt: str, model: str):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(URL, json={"prompt":prompt, "user": user, "user_group": "marvin", "model": model}) as response:
-            return await response.text()
+
+REPLAY_CHUNK_SIZE = 64
+
+async def _replay_generator(text: str):
+    data = text.encode('utf-8')
+    for i in range(0, len(data), REPLAY_CHUNK_SIZE):
+        yield data[i : i + REPLAY_CHUNK_SIZE]
+
+
+def replay(text: str) -> StreamingResponse:
+    # 缓存命中时按同样的流式接口返回已有答案
+    return StreamingResponse(_replay_generator(text))
+
+
+async def proxy_generator(user: str, prompt: str, model: str, on_complete=None):
+    """on_complete(full_text) is called once the whole answer was streamed successfully."""
+    session = await _get_session()
+    stats = _new_stats(user, model)
+    try:
+        async with session.post(URL, json={"prompt":prompt, "user": user, "user_group": "marvin", "model": model},
+                                trace_request_ctx=stats) as response:
+            chunks = []
+            nbytes = 0
+            first_at = None
+            async for data in response.content.iter_any():
+                if first_at is None:
+                    first_at = time.perf_counter()
+                    stats['ttfb'] = first_at - stats['start']
+                nbytes += len(data)
+                yield data
+                chunks.append(data)
+
+            # 一个汉字可能被拆在两个 chunk 里, 拼起来再解码
+            s = b''.join(chunks).decode('utf-8', errors='replace')
+            stats['bytes'] = nbytes
+            if first_at is not None and time.perf_counter() > first_at:
+                stats['throughput'] = nbytes / (time.perf_counter() - first_at)
+            logging.info('========start reply========')
+            logging.info(s)
+            logging.info('========end of reply========')
+            if on_complete and response.status == 200:
+                on_complete(s)
+    except Exception as e:
+        stats['error'] = str(e)
+        yield f'Exception: {e}'
+    finally:
+        _record_call('proxy_generator', stats)
+
+async def proxy_sync(user: str, prompt: str, model: str, session: Optional[aiohttp.ClientSession] = None):
+    # 后台线程里有自己的事件循环, 需要传入自己的 session
+    session = session or await _get_session()
+    stats = _new_stats(user, model)
+    try:
+        async with session.post(URL, json={"prompt":prompt, "user": user, "user_group": "marvin", "model": model},
+                                trace_request_ctx=stats) as response:
+            stats['ttfb'] = time.perf_counter() - stats['start']
+            text = await response.text()
+            stats['bytes'] = len(text.encode('utf-8'))
+            # 上游报错时的返回内容不能当作结果使用 (摘要会被保存, 分类结果会被缓存)
+            if response.status != 200:
+                raise Exception(f'upstream status={response.status}, body={text[:200]}')
+            return text
+    except Exception as e:
+        stats['error'] = str(e)
+        raise
+    finally:
+        _record_call('proxy_sync', stats)
@@ -0,0 +1,190 @@
+import re
+import json
+import logging
+from collections import Counter, OrderedDict
+from typing import List, Optional, Union
+
+import openai_proxy
+import metrics
+
+CATEGORY_VECTOR = '适合向量搜索的具体问题'
+CATEGORY_PAGES = '指定页面问题'
+CATEGORY_SUMMARY = '未指定任何具体信息的全文总结类问题'
+
+PATH_LOCAL_PAGES = 'local_pages'
+PATH_LOCAL_VECTOR = 'local_vector'
+PATH_LOCAL_SUMMARY = 'local_summary'
+PATH_LLM_CACHE = 'llm_cache'
+PATH_LLM = 'llm'
+
+MAX_PAGE_RANGE = 50
+LLM_CACHE_SIZE = 2000
+
+# 各条路径的命中次数, 用于统计本地路由的命中率
+route_stats = Counter()
+metrics.collect('chatbot_route_total', 'Questions routed, by routing path',
+                lambda: {(('path', path),): cnt for path, cnt in route_stats.items()}, type='counter')
+
+_llm_cache: OrderedDict = OrderedDict()
+
+JUDGE_PROMPT = """判断以下输入【问题】的类别，总共有三种类别:
+    1.【适合向量搜索的具体问题】
+    2.【指定页面问题】
+    3.【未指定任何具体信息的全文总结类问题】
+    问题中出现指定页面，则属于【指定页面问题】
+    问题中出现具体的任何名词、实体、具体段落、具体标题都属于【适合向量搜索的具体问题】
+
+你只需要输出最终答案，无需给出分析过程，最终答案采用json格式返回，格式为
+{"类别":"适合向量搜索的具体问题"}
+或者 {"类别":"未指定任何具体信息的全文总结类问题"}
+或者 {"类别":"指定页面问题", "pages":[17,23]}
+
+举例:
+    '详细总结关于 inequality and economics 的观点', 返回json: {"类别":"适合向量搜索的具体问题"}
+    '基于命名实体识别构建内容摘要', 返回json: {"类别":"未指定任何具体信息的全文总结类问题"}
+    '总结第17页到第18页 What Caused Elite Polarization? 下的7个观点', 返回json: {"类别":"指定页面问题", "pages": [17,18]}
+
+【问题】如下: """
+
+# 第17页 / 第17-18页 / 第17页到第18页 / 第17至20页
+_cn_page_pattern = re.compile(r'第\s*(\d+)\s*(?:页)?\s*(?:(?:-|~|－|—|到|至)\s*第?\s*(\d+)\s*)?页')
+# page 17 / pages 17-18 / p.17 / p17 to 20 / pages 3 and 5 / pages 3, 5-7
+# "-", "~", "to" 表示范围, ",", "and", "&" 分隔多个页码
+_en_page_range = r'\d+(?:\s*(?:-|~|to)\s*\d+)?'
+_en_page_pattern = re.compile(
+    rf'\b(?:pages?|pp?\.?)\s*({_en_page_range}(?:\s*(?:,\s*(?:and\s*)?|and\s+|&)\s*{_en_page_range})*)\b', re.IGNORECASE)
+_page_range_pattern = re.compile(r'(\d+)(?:\s*(?:-|~|to)\s*(\d+))?', re.IGNORECASE)
+
+# 书名号、引号里的内容 => 具体实体
+_quoted_pattern = re.compile(r'《[^》]+》|“[^”]+”|「[^」]+」|"[^"]+"|\'[^\']{2,}\'')
+# 型号/编号类: GPT4, ISO-9001, A3; 中文和英文之间没有 \b, 用前后不是字母数字判断边界, "介绍GPT4的特点" 也能匹配
+_code_pattern = re.compile(
+    r'(?<![A-Za-z0-9])(?=[A-Za-z0-9-]*[A-Za-z])(?=[A-Za-z0-9-]*\d)[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*(?![A-Za-z0-9])')
+# 连续的英文词组
+_latin_phrase_pattern = re.compile(r'[A-Za-z][A-Za-z\'-]+(?:\s+[A-Za-z][A-Za-z\'-]+)+')
+# 关于 xxx 的... 后面跟着英文
+_about_latin_pattern = re.compile(r'(?:关于|有关)\s*[A-Za-z]')
+
+_summary_cue_pattern = re.compile(r'总结|概括|概述|摘要|归纳|讲了什么|说了什么|主要内容|summar|overview|tl;?dr', re.IGNORECASE)
+# 整句就是一个泛泛的总结请求
+_pure_summary_pattern = re.compile(
+    r'^(?:请|麻烦)?(?:帮我|帮忙)?(?:总结|概括|概述|归纳)(?:一下)?(?:这篇|这本|本|全|整篇|整本)?(?:文章|文档|文件|书|全文|内容)?(?:的)?(?:主要)?(?:内容|观点)?$'
+    r'|^(?:这篇|这本|本)?(?:文章|文档|文件|书)(?:主要)?(?:讲了|说了)(?:些)?什么$'
+    r'|^(?:please\s+)?summari[sz]e(?:\s+(?:this|the))?(?:\s+(?:article|document|book|file|paper))?$',
+    re.IGNORECASE)
+
+
+def normalize_question(query_str: str) -> str:
+    s = re.sub(r'\s+', ' ', query_str.strip().lower())
+    return s.rstrip('?？。.!！ ')
+
+
+def _expand_pages(start: int, end: Optional[int]) -> List[int]:
+    if end is None or end < start:
+        return [start]
+    if end - start + 1 > MAX_PAGE_RANGE:
+        # 范围太大时只取前 MAX_PAGE_RANGE 页
+        logging.info(f'page range too wide, {start}-{end} clamped to {start}-{start + MAX_PAGE_RANGE - 1}')
+        end = start + MAX_PAGE_RANGE - 1
+    return list(range(start, end + 1))
+
+
+def parse_pages(query_str: str) -> List[int]:
+    ranges = [m.groups() for m in _cn_page_pattern.finditer(query_str)]
+    for m in _en_page_pattern.finditer(query_str):
+        ranges += [r.groups() for r in _page_range_pattern.finditer(m.group(1))]
+    pages = []
+    for start, end in ranges:
+        for p in _expand_pages(int(start), int(end) if end else None):
+            if p not in pages:
+                pages.append(p)
+    return pages
+
+
+def local_route(query_str: str) -> Optional[dict]:
+    """Classify the obvious questions without calling the LLM, return None when unsure."""
+    pages = parse_pages(query_str)
+    if pages:
+        return {'类别': CATEGORY_PAGES, 'pages': pages, 'path': PATH_LOCAL_PAGES}
+
+    normalized = normalize_question(query_str)
+    if _pure_summary_pattern.match(normalized):
+        return {'类别': CATEGORY_SUMMARY, 'path': PATH_LOCAL_SUMMARY}
+
+    if _quoted_pattern.search(query_str) or _code_pattern.search(query_str) or _about_latin_pattern.search(query_str):
+        return {'类别': CATEGORY_VECTOR, 'path': PATH_LOCAL_VECTOR}
+
+    # 中文问题里夹着英文词组, 且没有总结类字眼, 基本就是在问具体内容
+    if not _summary_cue_pattern.search(query_str) and re.search(r'[一-鿿]', query_str) \
+            and _latin_phrase_pattern.search(query_str):
+        return {'类别': CATEGORY_VECTOR, 'path': PATH_LOCAL_VECTOR}
+
+    return None
+
+
+def extract_json(s: str) -> Union[dict, None]:
+    # 正则表达式匹配最外层的大括号包围的内容，即JSON对象
+    matches = re.findall(r'{.*?}', s, re.DOTALL)
+    if matches:
+        # 假设最后一个匹配项是我们需要的JSON对象
+        json_str = matches[-1]
+        try:
+            return json.loads(json_str)
+        except json.JSONDecodeError:
+            print("Found JSON is not valid.")
+    return None
+
+
+def _parse_llm_verdict(question_type: str) -> dict:
+    if CATEGORY_VECTOR in question_type:
+        return {'类别': CATEGORY_VECTOR}
+    if CATEGORY_PAGES in question_type:
+        json_obj = extract_json(question_type) or {}
+        pages = json_obj.get('pages')
+        return {'类别': CATEGORY_PAGES, 'pages': pages if isinstance(pages, list) else []}
+    return {'类别': CATEGORY_SUMMARY}
+
+
+def _cache_get(key: str) -> Optional[dict]:
+    verdict = _llm_cache.get(key)
+    if verdict is not None:
+        _llm_cache.move_to_end(key)
+    return verdict
+
+
+def _cache_put(key: str, verdict: dict):
+    _llm_cache[key] = verdict
+    _llm_cache.move_to_end(key)
+    while len(_llm_cache) > LLM_CACHE_SIZE:
+        _llm_cache.popitem(last=False)
+
+
+async def route_question(user_name: str, query_str: str) -> dict:
+    """Return {'类别': ..., 'pages': [...], 'path': ...}, only asking the LLM when the local rules are unsure."""
+    verdict = local_route(query_str)
+    if verdict is None:
+        key = normalize_question(query_str)
+        cached = _cache_get(key)
+        if cached is not None:
+            verdict = dict(cached, path=PATH_LLM_CACHE)
+        else:
+            question_type = await openai_proxy.proxy_sync(user_name + ".judge", JUDGE_PROMPT + query_str, 'gpt-4')
+            logging.info(f'question_type={question_type}')
+            verdict = _parse_llm_verdict(question_type)
+            _cache_put(key, verdict)
+            verdict = dict(verdict, path=PATH_LLM)
+
+    route_stats[verdict['path']] += 1
+    logging.info(f'route question, path={verdict["path"]}, verdict={verdict}, stats={dict(route_stats)}')
+    return verdict
+
+
+if __name__ == '__main__':
+    # 本地路由的几个边界情况, 不请求 LLM
+    assert local_route('介绍GPT4的特点')['类别'] == CATEGORY_VECTOR
+    assert local_route('ISO-9001认证流程')['类别'] == CATEGORY_VECTOR
+    assert _code_pattern.search('abc123def') is not None and _code_pattern.search('第3页之后') is None
+    assert parse_pages('总结第1页到第200页') == list(range(1, MAX_PAGE_RANGE + 1))
+    assert parse_pages('pages 3 and 5') == [3, 5]
+    assert parse_pages('第17-18页') == [17, 18]
+    print('ok')
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+import aiohttp
+
+import config
+import openai_proxy
+
+SUMMARY_MODEL = getattr(config, 'SUMMARY_MODEL', 'gpt-3.5-turbo')
+SUMMARY_CONCURRENCY = getattr(config, 'SUMMARY_CONCURRENCY', 4)
+# 每个叶子节点合并多少字的页面, 每次 reduce 合并多少个下一级摘要
+LEAF_CHARS = 6000
+FANOUT = 8
+
+SUMMARY_KEY = 'summary_doc'
+
+LEAF_PROMPT = """请用中文概括以下文件/书/文章片段的要点, 保留关键的名词、数字和结论, 不超过300字:
+
+{text}
+"""
+
+REDUCE_PROMPT = """以下是同一个文件/书/文章中连续若干部分的摘要, 请按原文顺序合并成一段连贯的总结, 保留关键的名词、数字和结论, 不超过{limit}字:
+
+{text}
+"""
+
+
+def summary_doc_id(file_id):
+    # 摘要和页面存在同一个 PageStore 里, 单独一个文档
+    return f'{file_id}.summary'
+
+
+def _group_pages(page_texts: List[str]) -> List[str]:
+    groups = []
+    current = ''
+    for text in page_texts:
+        if current and len(current) + len(text) > LEAF_CHARS:
+            groups.append(current)
+            current = ''
+        current += text[:LEAF_CHARS] + '\n'
+    if current.strip():
+        groups.append(current)
+    return groups
+
+
+async def _summarize_all(session, semaphore, user, prompts: List[str]) -> List[str]:
+    async def one(prompt):
+        async with semaphore:
+            return await openai_proxy.proxy_sync(user, prompt, SUMMARY_MODEL, session=session)
+    return await asyncio.gather(*[one(prompt) for prompt in prompts])
+
+
+async def _build_tree(page_store, file_id, page_texts: List[str]) -> str:
+    doc_id = summary_doc_id(file_id)
+    user = f'{file_id}.summary'
+    semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(sock_connect=openai_proxy.CONNECT_TIMEOUT, sock_read=openai_proxy.READ_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        # map: 页面 -> 叶子摘要
+        groups = _group_pages(page_texts)
+        summaries = await _summarize_all(session, semaphore, user, [LEAF_PROMPT.format(text=g) for g in groups])
+        for i, summary in enumerate(summaries):
+            page_store.save_page(doc_id, f'summary_page_{i}', summary)
+        logging.info(f'summary leaf done, file_id={file_id}, pages={len(page_texts)}, leaves={len(summaries)}')
+
+        # reduce: 逐层合并, 直到只剩一个全文摘要
+        level = 0
+        while len(summaries) > 1:
+            level += 1
+            limit = 1000 if len(summaries) <= FANOUT else 500
+            prompts = [REDUCE_PROMPT.format(limit=limit, text='\n\n'.join(summaries[i : i + FANOUT]))
+                       for i in range(0, len(summaries), FANOUT)]
+            summaries = await _summarize_all(session, semaphore, user, prompts)
+            for i, summary in enumerate(summaries):
+                page_store.save_page(doc_id, f'summary_section_{level}_{i}', summary)
+            logging.info(f'summary level done, file_id={file_id}, level={level}, nodes={len(summaries)}')
+
+    return summaries[0] if summaries else ''
+
+
+def build_summary(page_store, file_id, page_texts: List[str]) -> str:
+    """Build the page -> section -> document summary tree and store it next to the pages.
+
+    Runs in an ingest worker thread, so it uses its own event loop and session.
+    """
+    summary = asyncio.run(_build_tree(page_store, file_id, page_texts))
+    if not summary.strip():
+        raise Exception(f'empty summary, file_id={file_id}')
+    page_store.save_page(summary_doc_id(file_id), SUMMARY_KEY, summary)
+    return summary
+
+
+def load_summary(page_store, file_id) -> Optional[str]:
+    return page_store.load_page(summary_doc_id(file_id), SUMMARY_KEY)
@@ -1,14 +1,15 @@
-from fastapi import FastAPI, UploadFile, File, Request, BackgroundTasks, Body
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, UploadFile, File, Form, Request, Body
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 import uuid
-from typing import Dict
+from typing import Dict, Optional
 import time
 import json
-from apscheduler.schedulers.background import BackgroundScheduler
 import logging
 import os
+import shutil
 
 import config
+import metrics
 
 import hashlib
 
@@ -23,8 +24,6 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s",
     level=logging.INFO
 )
-logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
-logging.getLogger('apscheduler.scheduler').setLevel(logging.WARNING)
 
 app = FastAPI(timeout=600)
 
@@ -51,24 +50,14 @@ UPLOAD_URL_FOLDER = f'{config.UPLOAD_HOST_PORT}/api7/static/uploaded/'
 
 # -------------files_db-----------------
 
-files_db: Dict[str, Dict[str, str]] = {}
+from FilesCatalog import FilesCatalog, STATUS_READY, STATUS_INGESTING
 
-def save_to_file():
-    with open(config.APP_NAME + "_files_db.json", "w") as f:
-        json.dump(files_db, f, indent=2)
-
-scheduler = BackgroundScheduler()
-scheduler.add_job(save_to_file, 'interval', minutes=2)
-scheduler.start()
+# 每次写入都立即提交, 不再定时整体 dump json
+files_db = FilesCatalog(config.APP_NAME + "_files_db.sqlite3")
 
 @app.on_event("startup")
 async def load_db():
-    global files_db
-    try:
-        with open(config.APP_NAME + "_files_db.json", "r") as f:
-            files_db = json.load(f)
-    except FileNotFoundError:
-        pass
+    files_db.import_json(config.APP_NAME + "_files_db.json")
 
 # ---------------------------------------
 
@@ -81,44 +70,63 @@ from pathlib import Path
 import openai_proxy
 import convert_to_txt
 import embedchain_util
+import summary_util
+import audio_transcribe
+import context_packer
+
+
+@app.on_event("startup")
+async def start_proxy_session():
+    # 全局复用一个连接池, 避免每次提问都重新建立 TCP/TLS 连接
+    await openai_proxy.startup()
 
 
-def get_full_txt(file_id):
-    file_url = files_db[str(file_id)]['url']
+@app.on_event("shutdown")
+async def close_proxy_session():
+    await openai_proxy.shutdown()
+
+
+def get_full_txt(file_id, model='gpt-3.5-turbo', prefer_summary=False):
+    # 全文总结类问题优先用入库时生成的全文摘要; 检索不到内容的具体问题仍然读原文
+    if prefer_summary:
+        summary = summary_util.load_summary(embedchain_util.g_page_store, file_id)
+        if summary:
+            logging.info(f'use precomputed summary, file_id={file_id}, chars={len(summary)}')
+            return summary
+
+    file_url = files_db.get(file_id)['url']
     local_file_path = file_url.replace(UPLOAD_URL_FOLDER, UPLOAD_LOCAL_FOLDER)
     full_txt = _get_full_txt(file_id, local_file_path)
-    MAX_SIZE = 6000
-    return full_txt[:MAX_SIZE]
+    # 按模型的 token 预算截断, 固定字数对中文会超出 gpt-3.5-turbo 的上下文
+    context = context_packer.truncate_to_tokens(full_txt, context_packer.context_budget(model), model)
+    logging.info(f'full txt truncated, file_id={file_id}, model={model}, chars={len(full_txt)}->{len(context)}')
+    return context
 
 
-def _get_full_txt(file_id, local_file_path):
+def _txt_file_path(local_file_path):
+    # 转换出的 txt 按上传文件名存放, 更新文档时新旧两版互不覆盖
     file_ext = Path(local_file_path).suffix
     if (file_ext != '.txt'):
-        local_file_path = os.path.join(os.path.dirname(local_file_path), 'tmp_files', f'{str(file_id)}{file_ext}.txt')
+        local_file_path = os.path.join(os.path.dirname(local_file_path), 'tmp_files', f'{Path(local_file_path).name}.txt')
+    return local_file_path
+
+
+def _get_full_txt(file_id, local_file_path):
+    local_file_path = _txt_file_path(local_file_path)
     logging.info(f'local txt file={local_file_path}')
     return convert_to_txt.read_txt_file(local_file_path)
 
 
-import re
-import json
-from typing import List, Union
-
-def extract_json(s: str) -> Union[dict, None]:
-    # 正则表达式匹配最外层的大括号包围的内容，即JSON对象
-    matches = re.findall(r'{.*?}', s, re.DOTALL)
-    if matches:
-        # 假设最后一个匹配项是我们需要的JSON对象
-        json_str = matches[-1]
-        try:
-            return json.loads(json_str)
-        except json.JSONDecodeError:
-            print("Found JSON is not valid.")
-    return None
-
-def parse_pages_from_json(json_obj: dict) -> List[int]:
-    if "pages" in json_obj and isinstance(json_obj["pages"], list):
-        return json_obj["pages"]
-    return []
+import asyncio
+import question_router
+
+askdoc_total = metrics.counter('chatbot_askdoc_total', '/api7/askdoc requests by the branch that answered')
+
+
+def _discard_task(task: asyncio.Task):
+    # 投机执行的检索结果用不上时丢弃, 并取走异常, 避免 "exception was never retrieved"
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
 
 
 @app.post("/api7/askdoc")
@@ -132,47 +140,51 @@ async def ask_doc(request: Request):
 
     if (file_id_list is None) or len(file_id_list) == 0:
         logging.info('未选择文件，转发到普通对话')
+        askdoc_total.inc(branch='chat')
         return await openai_proxy.proxy(user_name + '.chat', query_str, 'gpt-3.5-turbo')
 
-    prompt = """判断以下输入【问题】的类别，总共有三种类别: 
-    1.【适合向量搜索的具体问题】
-    2.【指定页面问题】
-    3.【未指定任何具体信息的全文总结类问题】
-    问题中出现指定页面，则属于【指定页面问题】
-    问题中出现具体的任何名词、实体、具体段落、具体标题都属于【适合向量搜索的具体问题】
-
-你只需要输出最终答案，无需给出分析过程，最终答案采用json格式返回，格式为
-{"类别":"适合向量搜索的具体问题"}
-或者 {"类别":"未指定任何具体信息的全文总结类问题"}
-或者 {"类别":"指定页面问题", "pages":[17,23]}
+    # 到开始流式返回答案为止的耗时, 上游的首字节/总耗时另外统计
+    with metrics.span('ask_doc'):
+        return await _ask_doc(file_id_list, query_str, user_name)
 
-举例:
-    '详细总结关于 inequality and economics 的观点', 返回json: {"类别":"适合向量搜索的具体问题"}
-    '基于命名实体识别构建内容摘要', 返回json: {"类别":"未指定任何具体信息的全文总结类问题"}
-    '总结第17页到第18页 What Caused Elite Polarization? 下的7个观点', 返回json: {"类别":"指定页面问题", "pages": [17,18]}
 
-【问题】如下: """
-    prompt = prompt + query_str
+async def _ask_doc(file_id_list, query_str, user_name):
+    # 分类(可能需要请求 gpt-4)的同时, 先在线程里开始向量检索, 两者耗时重叠
+    retrieval_task = None
+    local_verdict = question_router.local_route(query_str)
+    if local_verdict is None or local_verdict['类别'] == question_router.CATEGORY_VECTOR:
+        retrieval_task = asyncio.create_task(embedchain_util.aquery_doc(file_id_list, query_str))
 
     try:
-        question_type = await openai_proxy.proxy_sync(user_name + ".judge", prompt, 'gpt-4')
-        logging.info(f'question_type={question_type}')
+        with metrics.span('classify'):
+            verdict = await question_router.route_question(user_name, query_str)
     except Exception as e:
+        if retrieval_task:
+            _discard_task(retrieval_task)
+        askdoc_total.inc(branch='error')
         return f'Exception: {e}'
 
+    if retrieval_task and verdict['类别'] != question_router.CATEGORY_VECTOR:
+        logging.info('discard speculative retrieval')
+        _discard_task(retrieval_task)
+        retrieval_task = None
+
     ask_full_txt = False
     file_id = file_id_list[0]
 
     try:
-        if ('适合向量搜索的具体问题' in question_type):
+        if verdict['类别'] == question_router.CATEGORY_VECTOR:
             logging.info('适合向量搜索的具体问题')
-            return await embedchain_util.ask_doc(user_name + '.ask_doc', file_id_list, query_str)
+            with metrics.span('retrieval_wait'):
+                context_list = await retrieval_task
+            askdoc_total.inc(branch='vector')
+            return await embedchain_util.ask_doc_context(user_name + '.ask_doc', context_list, query_str, file_id_list)
         
-        elif ('指定页面问题' in question_type):
-            json_obj = extract_json(question_type)
-            page_number_list = parse_pages_from_json(json_obj)
+        elif verdict['类别'] == question_router.CATEGORY_PAGES:
+            page_number_list = verdict.get('pages', [])
+            askdoc_total.inc(branch='pages')
             return await embedchain_util.ask_doc_context(user_name + '.ask_doc', 
-                embedchain_util.get_context_list(file_id, page_number_list), query_str)
+                embedchain_util.get_context_list(file_id, page_number_list), query_str, [file_id], even_budget=True)
         else:
             logging.info('概括总结类问题')
         
@@ -182,10 +194,13 @@ async def ask_doc(request: Request):
             logging.info('未找到答案，则发送全文')
         else:
             logging.error(str(e))
+            askdoc_total.inc(branch='error')
             return {"code": 500, "msg": str(e)}
     
     # 最后全文提问
-    full_txt = get_full_txt(file_id)
+    askdoc_total.inc(branch='full_text')
+    with metrics.span('full_text_load'):
+        full_txt = get_full_txt(file_id, prefer_summary=verdict['类别'] == question_router.CATEGORY_SUMMARY)
     query_txt = f"""基于文件/书/文章的内容回答【问题】，【文件/书/文章内容】如下:
 {full_txt}
 
@@ -194,7 +209,8 @@ async def ask_doc(request: Request):
 【问题】:
 {query_str}
 """
-    return await openai_proxy.proxy(str(int(time.time())), query_txt, 'gpt-3.5-turbo')
+    return await embedchain_util.cached_answer(str(int(time.time())), query_txt, 'gpt-3.5-turbo',
+        query_str, [file_id], full_txt)
 
 
 
@@ -214,41 +230,152 @@ async def chat(request: Request):
 
 
 @app.post("/api7/getfiles")
-async def read_files():
-    return list(files_db.values())
+async def read_files(offset: int = 0, limit: Optional[int] = None, keyword: Optional[str] = None):
+    return files_db.list(offset=offset, limit=limit, keyword=keyword)
 
 
-@app.post("/api7/uploadfile")
-async def create_upload_file(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
-    file = files[0]
-    contents = await file.read()
-    file_id = str(int(time.time()))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 正在处理中的文件 md5 -> file_id, 处理完成前重复上传也直接返回
+pending_md5: Dict[str, str] = {}
+
+_last_file_id = 0
+
+def _new_file_id():
+    # file_id 是时间戳, 同一秒内多个文件时顺延, 保证唯一
+    global _last_file_id
+    _last_file_id = max(int(time.time()), _last_file_id + 1)
+    return str(_last_file_id)
+
+
+async def _save_upload(file: UploadFile, directory: str):
+    # 分块写入临时文件, 边写边算 md5, 内存占用与文件大小无关
+    # 算 md5 和写文件放到线程里, 不阻塞事件循环
+    hasher = hashlib.md5()
+    tmp_file_path = f"{directory}/.upload_{uuid.uuid4().hex}"
+
+    def write_chunk(f, chunk):
+        hasher.update(chunk)
+        f.write(chunk)
+
+    try:
+        with open(tmp_file_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(write_chunk, f, chunk)
+    except BaseException:
+        # 读取/写入失败或请求被取消时不留下临时文件
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
+    return tmp_file_path, hasher.hexdigest()
+
+
+async def _upload_one_file(file: UploadFile):
     current_month = datetime.now().strftime("%Y%m")
+    directory = f"{UPLOAD_LOCAL_FOLDER}{current_month}"
+    os.makedirs(directory, exist_ok=True)
+
+    tmp_file_path, file_md5 = await _save_upload(file, directory)
+    t = files_db.get_by_md5(file_md5)
+    if t:
+        os.remove(tmp_file_path)
+        return t
+    if file_md5 in pending_md5:
+        os.remove(tmp_file_path)
+        return {"task_id": pending_md5[file_md5]}
+
+    file_id = _new_file_id()
     file_name = file.filename
     file_ext = Path(file_name).suffix
     new_file_name = str(file_id) + file_ext
 
     file_url = f'{UPLOAD_URL_FOLDER}{current_month}/{new_file_name}'
-    directory = f"{UPLOAD_LOCAL_FOLDER}{current_month}"
-    os.makedirs(directory, exist_ok=True)
-    
     local_file_path = f"{directory}/{new_file_name}"
-    with open(local_file_path, "wb") as f:
-        f.write(contents)
+    os.replace(tmp_file_path, local_file_path)
 
-    file_md5 = generate_md5(local_file_path)
-    for file1 in files_db:
-        t = files_db[file1]
-        if (t['file_md5'] == file_md5):
-            return t
-        
-    background_tasks.add_task(process_file_task, file_id, file_md5, file_ext, file_name, new_file_name, file_url, local_file_path)
+    pending_md5[file_md5] = file_id
+    process_file_task(file_id, file_md5, file_ext, file_name, new_file_name, file_url, local_file_path)
     return {"task_id": file_id}
 
 
+@app.post("/api7/uploadfile")
+async def create_upload_file(files: List[UploadFile] = File(...)):
+    results = [await _upload_one_file(file) for file in files]
+    if len(results) == 1:
+        return results[0]
+
+    # 多个文件: 返回每个文件的结果, 同时带上第一个新任务的 task_id 以便前端跟踪进度
+    response = {"results": results}
+    for result in results:
+        if 'task_id' in result:
+            response['task_id'] = result['task_id']
+            break
+    return response
+
+
+def _remove_upload(local_file_path):
+    # 删除上传的原文件和转换出的 txt
+    for path in {local_file_path, _txt_file_path(local_file_path)}:
+        if os.path.exists(path):
+            os.remove(path)
+    # 音频转写失败时留下的分段结果
+    shutil.rmtree(_txt_file_path(local_file_path) + '.segments', ignore_errors=True)
+
+
+@app.post("/api7/updatefile")
+async def update_upload_file(file_id: str = Form(...), file: UploadFile = File(...)):
+    # 上传修改后的文件替换已有文档, 只重新 embedding 有变化的页面
+    record = files_db.get(file_id)
+    if record is None:
+        return {"code": 500, "msg": f'file not exist: {file_id}'}
+    if file_id in pending_md5.values():
+        return {"code": 500, "msg": '文件处理中, 请稍后再试'}
+
+    old_local_file_path = record['url'].replace(UPLOAD_URL_FOLDER, UPLOAD_LOCAL_FOLDER)
+    directory = os.path.dirname(old_local_file_path)
+    tmp_file_path, file_md5 = await _save_upload(file, directory)
+    t = files_db.get_by_md5(file_md5)
+    if t:
+        os.remove(tmp_file_path)
+        return t
+
+    file_name = file.filename
+    file_ext = Path(file_name).suffix
+    # 新版本用不同的文件名, 旧文件在重新入库成功后才删除, 期间全文提问仍然读旧文件
+    new_file_name = f'{file_id}_{int(time.time())}{file_ext}'
+    file_url = f"{os.path.dirname(record['url'])}/{new_file_name}"
+    local_file_path = f"{directory}/{new_file_name}"
+    os.replace(tmp_file_path, local_file_path)
+
+    pending_md5[file_md5] = file_id
+    if not process_file_task(file_id, file_md5, file_ext, file_name, new_file_name, file_url, local_file_path,
+                             replaces_url=record['url']):
+        pending_md5.pop(file_md5, None)
+        _remove_upload(local_file_path)
+        return {"code": 500, "msg": '文件处理中, 请稍后再试'}
+    return {"task_id": file_id}
+
+
+@app.post("/api7/deletefile")
+async def delete_file(file_id: str = Body(..., embed=True)):
+    record = files_db.get(file_id)
+    if record is None:
+        return {"code": 500, "msg": f'file not exist: {file_id}'}
+    if file_id in pending_md5.values():
+        return {"code": 500, "msg": '文件处理中, 请稍后再试'}
+
+    files_db.delete(file_id)
+    await asyncio.to_thread(embedchain_util.delete_doc, file_id)
+    embedchain_util.g_page_store.drop(summary_util.summary_doc_id(file_id))
+    embedchain_util.g_answer_cache.invalidate(file_id)
+    embedchain_util.g_semantic_cache.invalidate(file_id)
+    _remove_upload(record['url'].replace(UPLOAD_URL_FOLDER, UPLOAD_LOCAL_FOLDER))
+    logging.info(f'file deleted, file_id={file_id}, filename={record["filename"]}')
+    return {"code": 200, "msg": "ok"}
+
+
 @app.post("/api7/embed_local_pdf")
-async def embed_local_pdf(background_tasks: BackgroundTasks, 
-                          file_name:str = Body(...), current_month:str = Body(...), file_id: str = Body(...)):
+async def embed_local_pdf(file_name:str = Body(...), current_month:str = Body(...), file_id: str = Body(...)):
     file_ext = '.pdf'
     new_file_name = str(file_id) + file_ext
 
@@ -257,9 +384,15 @@ async def embed_local_pdf(background_tasks: BackgroundTasks,
     os.makedirs(directory, exist_ok=True)
     local_file_path = f"{directory}/{new_file_name}"
     file_md5 = generate_md5(local_file_path)
-    txt_content = _get_full_txt(file_id, local_file_path)
-
-    background_tasks.add_task(process_file_task, file_id, file_md5, file_ext, file_name, new_file_name, file_url, local_file_path, txt_content)
+    t = files_db.get_by_md5(file_md5)
+    if t and t['file_id'] != str(file_id):
+        return t
+    txt_path = _txt_file_path(local_file_path)
+    if not os.path.exists(txt_path):
+        return {"code": 500, "msg": f'txt file not exist: {txt_path}'}
+
+    if not process_file_task(file_id, file_md5, file_ext, file_name, new_file_name, file_url, local_file_path, txt_path):
+        return {"code": 500, "msg": '文件处理中, 请稍后再试'}
     return {"task_id": file_id}
 
 
@@ -267,62 +400,314 @@ def format_timestamp(file_id):
     return datetime.fromtimestamp(int(file_id)).strftime("%m/%d-%H:%M")
 
 
-task_status = {}
-
-def process_file_task(file_id, file_md5, file_ext, file_name, new_file_name, file_url, local_file_path, txt_content = None):
-
-    task_status[file_id] = 'processing'
-    if txt_content is None:
-        if (file_ext.lower() == '.pdf'):
-            iter = convert_to_txt.pdf_to_txt_stream(local_file_path)
-            first = True
-            pages = 0
-            for msg in iter:
-                logging.info(f'msg={msg}')
-                if first and msg:
-                    first = False
-                    pages = msg.split(',')[0]
-                    local_txt_file = msg.split(',')[1]
-                    task_status[file_id] = f"总页数: {pages}, 解析第1页文本"
-                else:
-                    task_status[file_id] = f'共{pages}页,已解析{msg}/{pages}'
-            txt_content = convert_to_txt.read_txt_file(local_txt_file)
-        else:
-            task_status[file_id] = '解析文本中'
-            txt_content = convert_to_txt.notpdf_to_txt_content(file_ext, local_file_path)
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from StatusBroker import create_status_broker, FINISHED_STATUS
+from IngestQueue import IngestQueue
+
+STATUS_HEARTBEAT_SECONDS = 15
 
-    task_status[file_id] = '训练内容中'
-    embedchain_util.embed_doc(file_id, txt_content)
+INGEST_EMBED_WORKERS = getattr(config, 'INGEST_EMBED_WORKERS', 1)
+# 边解析边 embedding 的批次和 embed 阶段共用这些名额, 同时在做 embedding 的文档数不超过 INGEST_EMBED_WORKERS
+g_embed_slots = threading.BoundedSemaphore(INGEST_EMBED_WORKERS)
 
-    files_db[file_id] = {
-        "filename": file_name,
-        "newfilename": new_file_name,
+ingest_jobs_total = metrics.counter('chatbot_ingest_jobs_total', 'Ingest jobs enqueued by process_file_task')
+
+# 配置了 STATUS_REDIS_URL 时状态通过 redis 在多个 worker 进程间共享
+status_broker = create_status_broker(getattr(config, 'STATUS_REDIS_URL', None))
+
+def _catalog_record(file_id, args, status=STATUS_READY):
+    return {
+        "filename": args['file_name'],
+        "newfilename": args['new_file_name'],
         "file_id": file_id,
-        "file_md5": file_md5,
+        "file_md5": args['file_md5'],
         "selected": False,
         "uploadtime": format_timestamp(file_id),
-        'url': file_url,
+        'url': args['file_url'],
+        'status': status,
     }
-    task_status[file_id] = "完成"
+
+
+class _StreamEmbedder:
+    """Embeds the finished pages of a txt file while the parser is still writing it.
+
+    While one batch is embedding, newly finished pages wait and go out together as
+    the next batch, so total time approaches max(parse, embed) instead of the sum.
+    """
+
+    def __init__(self, file_id, args, txt_path, report):
+        self.file_id = file_id
+        self.args = args
+        self.report = report
+        self.embedded = 0
+        self._tail = convert_to_txt.TxtPageTail(txt_path)
+        self._pending = []
+        self._future = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stream-embed')
+
+    def _embed(self, batch):
+        with g_embed_slots:
+            embedchain_util.embed_stream_pages(self.file_id, batch)
+        self.embedded += len(batch)
+        if files_db.get(self.file_id) is None:
+            # 新文档: 第一批页面可以检索后就加入文件列表, 标记为入库中, 重试和其他进程都能看到
+            if not files_db.put(_catalog_record(self.file_id, self.args, STATUS_INGESTING)):
+                raise Exception(f'file_md5 already in catalog: {self.args["file_md5"]}')
+        self.report()
+
+    def poll(self, final=False):
+        self._pending += self._tail.read(final)
+        if final and self._future is not None:
+            self._future.result()
+            self._future = None
+        if self._pending and (self._future is None or self._future.done()):
+            if self._future is not None:
+                self._future.result()
+            self._future = self._executor.submit(self._embed, self._pending)
+            self._pending = []
+
+    def finish(self):
+        self.poll(final=True)
+        if self._future is not None:
+            self._future.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def _stream_pdf(file_id, args):
+    # 解析服务逐页输出, 已写完的页面边解析边 embedding
+    embedder = None
+    local_txt_file = None
+    pages = 0
+    parsed = 0
+
+    def report():
+        status_broker.set(file_id, f'共{pages}页,已解析{parsed}/{pages},已训练{embedder.embedded}页')
+
+    try:
+        for msg in convert_to_txt.pdf_to_txt_stream(args['local_file_path']):
+            logging.info(f'msg={msg}')
+            if embedder is None and msg:
+                pages = msg.split(',')[0]
+                local_txt_file = msg.split(',')[1]
+                embedder = _StreamEmbedder(file_id, args, local_txt_file, report)
+                status_broker.set(file_id, f"总页数: {pages}, 解析第1页文本")
+            elif embedder is not None:
+                parsed = msg
+                embedder.poll()
+                report()
+        if embedder is not None:
+            embedder.finish()
+    finally:
+        if embedder is not None:
+            embedder.close()
+    return local_txt_file
+
+
+def _stream_audio(file_id, args):
+    # 音频分段并行转写, 每段转写完按顺序写成一页, 同时 embedding
+    local_txt_file = _txt_file_path(args['local_file_path'])
+    os.makedirs(os.path.dirname(local_txt_file), exist_ok=True)
+    segments = 0
+    done = 0
+
+    def report():
+        status_broker.set(file_id, f'共{segments}段,已转写{done}/{segments},已训练{embedder.embedded}段')
+
+    # 先写到临时文件, 转写完整之后再换成正式的 txt, 中途失败不会留下不完整的结果
+    # 已转写的段保存在 .segments 目录, 重试时不再重新转写
+    tmp_txt_file = local_txt_file + '.part'
+    segment_dir = local_txt_file + '.segments'
+    embedder = _StreamEmbedder(file_id, args, tmp_txt_file, report)
+    try:
+        with open(tmp_txt_file, 'w') as f:
+            for done, segments, page in audio_transcribe.transcribe_pages(args['local_file_path'], cache_dir=segment_dir):
+                f.write(convert_to_txt.PAGE_MARKER + page)
+                f.flush()
+                embedder.poll()
+                report()
+        embedder.finish()
+        os.replace(tmp_txt_file, local_txt_file)
+        shutil.rmtree(segment_dir, ignore_errors=True)
+    finally:
+        embedder.close()
+    return local_txt_file
+
+
+def _parse_stage(file_id, args):
+    file_ext = args['file_ext']
+    local_file_path = args['local_file_path']
+
+    status_broker.set(file_id, 'processing')
+    if (file_ext.lower() == '.pdf'):
+        local_txt_file = _stream_pdf(file_id, args)
+    elif audio_transcribe.is_audio(local_file_path):
+        local_txt_file = _stream_audio(file_id, args)
+    elif file_ext == '.txt':
+        local_txt_file = local_file_path
+    else:
+        status_broker.set(file_id, '解析文本中')
+        txt_content = convert_to_txt.notpdf_to_txt_content(file_ext, local_file_path)
+        # 解析结果落盘, 重试/重启后 embed 阶段直接读取
+        local_txt_file = _txt_file_path(local_file_path)
+        if not os.path.exists(local_txt_file):
+            os.makedirs(os.path.dirname(local_txt_file), exist_ok=True)
+            with open(local_txt_file, 'w') as f:
+                f.write(txt_content)
+
+    args['txt_path'] = local_txt_file
+    return args
+
+
+def _embed_stage(file_id, args):
+    status_broker.set(file_id, '训练内容中')
+    embedchain_util.g_answer_cache.invalidate(file_id)
+    embedchain_util.g_semantic_cache.invalidate(file_id)
+    txt_content = convert_to_txt.read_txt_file(args['txt_path'])
+
+    def on_pages_done(page_keys, done_cnt, total_cnt):
+        ingest_queue.mark_pages_done(file_id, page_keys)
+        status_broker.set(file_id, f'训练内容中, 已完成{done_cnt}/{total_cnt}页')
+
+    record = files_db.get(file_id)
+    reingest = record is not None and record['status'] != STATUS_INGESTING
+    completed_pages = ingest_queue.completed_pages(file_id)
+    with g_embed_slots:
+        stats = embedchain_util.embed_doc(file_id, txt_content, completed_pages, on_pages_done)
+    # 中断前已经 embedding 过的页面也算内容有变化
+    args['content_changed'] = bool(completed_pages or stats.get('added') or stats.get('changed') or stats.get('removed'))
+    if reingest and args['content_changed']:
+        # 内容变了, 旧的全文摘要作废, 开启摘要阶段时会重新生成
+        embedchain_util.g_page_store.drop(summary_util.summary_doc_id(file_id))
+
+    if not files_db.put(_catalog_record(file_id, args)):
+        raise Exception(f'file_md5 already in catalog: {args["file_md5"]}')
+    if args.get('replaces_url') and args['replaces_url'] != args['file_url']:
+        # 更新文档: 新版本已经生效, 删除旧的上传文件和 txt
+        _remove_upload(args['replaces_url'].replace(UPLOAD_URL_FOLDER, UPLOAD_LOCAL_FOLDER))
+    pending_md5.pop(args['file_md5'], None)
+    status_broker.set(file_id, FINISHED_STATUS)
     logging.info(f'process file done, id={file_id}')
+    return args
+
+
+def _summarize_stage(file_id, args):
+    page_store = embedchain_util.g_page_store
+    if files_db.get(file_id) is None:
+        logging.info(f'summary skipped, file deleted, file_id={file_id}')
+        return args
+    if not args.get('content_changed', True) and summary_util.load_summary(page_store, file_id) is not None:
+        # 重新入库但页面都没变, 已有的摘要仍然有效, 不再请求 LLM
+        logging.info(f'summary skipped, content unchanged, file_id={file_id}')
+        return args
+
+    # 按原文的页面顺序; page_keys() 是写入顺序, 重新入库后变化的页面会排在最后
+    txt_content = convert_to_txt.read_txt_file(args['txt_path'])
+    page_texts = [text_page for _, text_page, _ in embedchain_util.split_pages(txt_content)]
+    summary = summary_util.build_summary(page_store, file_id, page_texts)
+    if files_db.get(file_id) is None:
+        # 生成摘要期间文档被删除了, 删掉刚写入的摘要页面
+        page_store.drop(summary_util.summary_doc_id(file_id))
+        logging.info(f'summary dropped, file deleted while summarizing, file_id={file_id}')
+        return args
+    embedchain_util.g_answer_cache.invalidate(file_id)
+    logging.info(f'summary done, file_id={file_id}, chars={len(summary)}')
+    return args
+
+
+def _on_ingest_failed(file_id, stage, args, error):
+    if stage == 'summarize':
+        # 摘要失败不影响文档使用, 全文类问题退回到读取 txt
+        return
+    record = files_db.get(file_id)
+    if record is not None and record['status'] == STATUS_INGESTING:
+        # 解析时提前加入列表的新文档, 处理失败后移除, 重新上传时可以再次处理
+        files_db.delete(file_id)
+    if args.get('replaces_url') and args['replaces_url'] != args['file_url']:
+        # 更新文档失败: 删除新上传的文件, catalog 仍指向旧文件
+        _remove_upload(args['local_file_path'])
+    pending_md5.pop(args['file_md5'], None)
+    status_broker.set(file_id, f'处理失败: {error}')
+    status_broker.set(file_id, FINISHED_STATUS)
+
+
+# 解析和 embedding 分阶段执行, 各自的并发数可配置; split 在 embed 阶段内完成
+ingest_stages = [
+    ('parse', _parse_stage, getattr(config, 'INGEST_PARSE_WORKERS', 2)),
+    ('embed', _embed_stage, INGEST_EMBED_WORKERS),
+]
+# 可选: 文档可用之后, 在后台生成 页面 -> 章节 -> 全文 的摘要树
+if getattr(config, 'SUMMARY_STAGE_ENABLED', False):
+    ingest_stages.append(('summarize', _summarize_stage, getattr(config, 'INGEST_SUMMARY_WORKERS', 1)))
+
+ingest_queue = IngestQueue(
+    config.APP_NAME + "_ingest_queue.sqlite3",
+    stages=ingest_stages,
+    max_attempts=getattr(config, 'INGEST_MAX_ATTEMPTS', 3),
+    on_failed=_on_ingest_failed,
+)
+
+metrics.collect('chatbot_ingest_queue_jobs', 'Ingest jobs waiting or running, by stage',
+                lambda: {(('stage', stage), ('state', state)): cnt
+                         for stage, states in ingest_queue.depth().items() for state, cnt in states.items()})
+
+
+@app.get("/api7/metrics")
+async def get_metrics():
+    # Prometheus 文本格式
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.on_event("startup")
+async def start_ingest_queue():
+    ingest_queue.start()
+
+
+def process_file_task(file_id, file_md5, file_ext, file_name, new_file_name, file_url, local_file_path, txt_path = None,
+                      replaces_url = None):
+    # 同一个文档正在处理时不会重复入队, 返回 False; replaces_url: 更新文档时被替换的旧文件
+    args = {
+        'file_md5': file_md5,
+        'file_ext': file_ext,
+        'file_name': file_name,
+        'new_file_name': new_file_name,
+        'file_url': file_url,
+        'local_file_path': local_file_path,
+    }
+    if replaces_url:
+        args['replaces_url'] = replaces_url
+    ingest_jobs_total.inc(kind='upload' if txt_path is None else 'local_txt')
+    # 小文件优先, 避免被几百页的大书堵住
+    priority = os.path.getsize(local_file_path) // 1024
+    if txt_path is None:
+        accepted = ingest_queue.enqueue(file_id, args, priority)
+    else:
+        args['txt_path'] = txt_path
+        accepted = ingest_queue.enqueue(file_id, args, priority, stage='embed')
+    if accepted:
+        status_broker.set(file_id, '排队中')
+    return accepted
 
 
 @app.get("/api7/status/{file_id}")
 async def get_task_status(file_id: str):
-    def event_stream():
-        prev_status = None
-        if file_id not in task_status:
+    async def event_stream():
+        if await status_broker.aget(file_id) is None:
             logging.error(f'file_id={file_id} not in task_status, force closing')
             yield f"data: done\n\n"
             return
-        
-        while task_status.get(str(file_id)) != "完成":
-            status = task_status.get(str(file_id))
-            if (status != prev_status):
-                logging.info(f'file_id={file_id}, status={status}')
-                yield f"data: {status}\n\n"
-                prev_status = status
-            time.sleep(1)
+
+        async for status in status_broker.subscribe(file_id, heartbeat=STATUS_HEARTBEAT_SECONDS):
+            if status is None:
+                # 心跳, 防止代理断开空闲连接
+                yield ": ping\n\n"
+                continue
+            if status == FINISHED_STATUS:
+                break
+            logging.info(f'file_id={file_id}, status={status}')
+            yield f"data: {status}\n\n"
 
         yield f"data: done\n\n"
     return StreamingResponse(event_stream(), media_type="text/event-stream")